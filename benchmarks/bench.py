@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import pathlib
+import argparse
+import importlib.util
+from contextlib import contextmanager
+from mitmproxy import http
+from mitmproxy.test import taddons, tflow
+from doubletap import ratelimit
+from doubletap.aws import AWSProxies, normalize_origin
+from benchmarks.fakeapigw import ControlPlane, DataPlane, FakeSession
+
+ADDON = pathlib.Path(__file__).resolve().parent.parent / "doubletap.py"
+
+
+def load_addon():
+    # doubletap.py shares its name with the package, it has to be loaded from its path
+    spec = importlib.util.spec_from_file_location("doubletap_addon", ADDON)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextmanager
+def scaled_budgets(scale):
+    # Rate limiters are cached per region and read the budgets when they're created,
+    # they get recreated with the scaled budgets and again once the originals are back
+    account, operations = ratelimit.ACCOUNT_BUDGET, ratelimit.OPERATION_BUDGETS
+    rate, burst = account
+    ratelimit.ACCOUNT_BUDGET = (rate * scale, burst)
+    ratelimit.OPERATION_BUDGETS = {
+        operation: (rate * scale, burst) for operation, (rate, burst) in operations.items()
+    }
+    ratelimit._limiters.clear()
+    try:
+        yield
+    finally:
+        ratelimit.ACCOUNT_BUDGET, ratelimit.OPERATION_BUDGETS = account, operations
+        ratelimit._limiters.clear()
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+class Reply:
+    # Stands in for the proxy core, which holds intercepted flows until the addon resumes or kills them
+    def __init__(self):
+        self.state = "start"
+        self.done = asyncio.Event()
+
+    def take(self):
+        self.state = "taken"
+
+    def ack(self, force=False):
+        pass
+
+    def commit(self):
+        self.state = "committed"
+        self.done.set()
+
+    def kill(self, force=False):
+        self.commit()
+
+
+def make_flow(url, path="/"):
+    flow = tflow.tflow()
+    flow.request.url = url.rstrip("/") + path
+    flow.reply = Reply()
+    return flow
+
+
+async def bench_prestage(proxies, count):
+    urls = [f"https://prestage-{i}.example.com/" for i in range(count)]
+    started = time.monotonic()
+    await proxies.bulk_create(urls)
+    elapsed = time.monotonic() - started
+
+    staged = sum(1 for url in urls if proxies.get(url))
+    return {
+        "hosts": count,
+        "staged": staged,
+        "seconds": elapsed,
+        "hosts_per_second": staged / elapsed if elapsed else 0,
+    }
+
+
+async def bench_standby(proxies, size):
+    started = time.monotonic()
+    await proxies.fill_standby()
+    return {"size": size, "seconds": time.monotonic() - started}
+
+
+async def bench_cold(addon, count):
+    # A burst of requests to hosts nothing was created for yet, each one waits in request() until it's proxied
+    async def request(url):
+        flow = make_flow(url)
+        started = time.monotonic()
+        addon.request(flow)
+        if flow.intercepted:
+            await flow.reply.done.wait()
+        return time.monotonic() - started, flow.error is None
+
+    results = await asyncio.gather(
+        *[request(f"https://cold-{i}.example.com/") for i in range(count)]
+    )
+    latencies = [elapsed for elapsed, proxied in results if proxied]
+    return {
+        "hosts": count,
+        "dropped": count - len(latencies),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies, default=0),
+    }
+
+
+def bench_requests(addon, dataplane, urls, count, rng):
+    # Only the hooks are timed, building flows and answering them is the proxy core's and API Gateway's job
+    flows = [make_flow(rng.choice(urls), "/index.html") for _ in range(count)]
+    timings = []
+    errors = 0
+    for flow in flows:
+        origin = normalize_origin(flow.request.url)
+
+        started = time.perf_counter()
+        addon.request(flow)
+        elapsed = time.perf_counter() - started
+
+        status_code, headers, proxied_to = dataplane.resolve(
+            flow.request.host, flow.request.path
+        )
+        if proxied_to != origin:
+            errors += 1
+        flow.response = http.HTTPResponse.make(status_code, b"", headers)
+
+        started = time.perf_counter()
+        addon.responseheaders(flow)
+        addon.response(flow)
+        timings.append(elapsed + time.perf_counter() - started)
+
+    return {
+        "count": count,
+        "errors": errors,
+        "rps": count / sum(timings) if timings else 0,
+        "p50_us": percentile(timings, 50) * 1e6,
+        "p99_us": percentile(timings, 99) * 1e6,
+    }
+
+
+async def run(args):
+    # Loading the addon already creates rate limiters
+    with scaled_budgets(args.quota_scale):
+        return await benchmark(args)
+
+
+async def benchmark(args):
+    module = load_addon()
+    addon = module.addons[0]
+
+    plane = ControlPlane(
+        latency=args.latency,
+        staging_delay=args.staging_delay,
+        quota_scale=args.quota_scale,
+    )
+    dataplane = DataPlane(plane)
+
+    await addon.proxies.close()
+    addon.proxies = AWSProxies(regions=module.REGIONS[: args.regions])
+    addon.proxies.session = FakeSession(plane)
+    addon.proxies.readiness.client = dataplane
+
+    results = {}
+    with taddons.context(addon) as tctx:
+        tctx.configure(
+            addon,
+            registry="",
+            ready_quorum=args.quorum,
+            standby_pool=args.standby,
+            proxy_method=args.proxy_method,
+        )
+        try:
+            await addon.proxies.setup()
+            if args.prestage:
+                results["prestage"] = await bench_prestage(addon.proxies, args.prestage)
+            if args.standby:
+                results["standby"] = await bench_standby(addon.proxies, args.standby)
+            if args.cold:
+                results["cold"] = await bench_cold(addon, args.cold)
+
+            urls = list(addon.proxies.index)
+            if args.requests and urls:
+                results["requests"] = bench_requests(
+                    addon, dataplane, urls, args.requests, random.Random(args.seed)
+                )
+        finally:
+            await addon.close()
+
+    results["control_plane"] = {
+        "calls": sum(plane.calls.values()),
+        "throttled": sum(plane.throttled.values()),
+    }
+    return results
+
+
+def report(args, results):
+    print(
+        f"DOUBLETAP benchmark: {args.regions} region(s), {args.latency * 1000:.0f}ms control plane latency, "
+        f"{args.staging_delay}s staging delay, quota scale {args.quota_scale}"
+    )
+    if "prestage" in results:
+        r = results["prestage"]
+        print(
+            f"  prestage       {r['staged']}/{r['hosts']} hosts in {r['seconds']:.2f}s ({r['hosts_per_second']:.1f} hosts/s)"
+        )
+    if "standby" in results:
+        r = results["standby"]
+        print(f"  standby pool   {r['size']} endpoint(s) per region in {r['seconds']:.2f}s")
+    if "cold" in results:
+        r = results["cold"]
+        print(
+            f"  cold hosts     {r['hosts']} hosts, p50 {r['p50']:.2f}s p99 {r['p99']:.2f}s max {r['max']:.2f}s ({r['dropped']} dropped)"
+        )
+    if "requests" in results:
+        r = results["requests"]
+        print(
+            f"  requests       {r['count']} at {r['rps']:.0f} req/s, p50 {r['p50_us']:.0f}us p99 {r['p99_us']:.0f}us ({r['errors']} misrouted)"
+        )
+    r = results["control_plane"]
+    print(f"  control plane  {r['calls']} call(s), {r['throttled']} throttled")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark DOUBLETAP against a local API Gateway stand-in, no AWS account needed"
+    )
+    parser.add_argument("--regions", type=int, default=3, help="Number of regions to proxy through")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every control plane call takes")
+    parser.add_argument("--staging-delay", type=float, default=2, help="Seconds until a deployment is live")
+    parser.add_argument(
+        "--quota-scale",
+        type=float,
+        default=1,
+        help="Multiplies API Gateway's rate quotas and DOUBLETAP's budgets for quicker runs (1 matches AWS)",
+    )
+    parser.add_argument("--prestage", type=int, default=300, help="Number of hosts to prestage")
+    parser.add_argument("--standby", type=int, default=0, help="Standby pool size per region")
+    parser.add_argument("--cold", type=int, default=10, help="Number of new hosts requested at once")
+    parser.add_argument("--quorum", type=int, default=1, help="ready_quorum option")
+    parser.add_argument("--proxy-method", default="random", help="proxy_method option")
+    parser.add_argument("--requests", type=int, default=20000, help="Number of requests to known hosts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # The package logs everything at debug level by default
+    logging.getLogger("doubletap").setLevel(
+        logging.DEBUG if args.verbose else logging.ERROR
+    )
+    # Never used for anything, the addon just refuses to start without them
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(args, results)
+
+
+if __name__ == "__main__":
+    main()
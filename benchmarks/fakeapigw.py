@@ -0,0 +1,389 @@
+import re
+import json
+import time
+import asyncio
+import datetime
+import itertools
+from collections import Counter
+from urllib.parse import urlsplit
+from botocore.exceptions import ClientError
+
+# API Gateway's control plane quotas per account and region, (requests per second, burst).
+# Kept apart from doubletap.ratelimit on purpose, the benchmark should notice if those drift from what AWS enforces.
+ACCOUNT_QUOTA = (10, 40)
+OPERATION_QUOTAS = {
+    "create_deployment": (1 / 5, 1),
+    "create_resource": (5, 5),
+    "create_rest_api": (1 / 3, 1),
+    "delete_resource": (5, 5),
+    "delete_rest_api": (1 / 30, 1),
+    "get_resources": (5 / 2, 5),
+    "put_rest_api": (1, 1),
+}
+
+STAGE_VARIABLE = re.compile(r"\$\{stageVariables\.(\w+)\}")
+
+META = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+def response(**kwargs):
+    return dict(META, **kwargs)
+
+
+def error(operation, code, message="", status=400):
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": message},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        operation,
+    )
+
+
+def page(items, limit=25, position=None):
+    start = int(position or 0)
+    result = {"items": items[start : start + limit]}
+    if start + limit < len(items):
+        result["position"] = str(start + limit)
+    return result
+
+
+class Quota:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+
+class ControlPlane:
+    # Every region's APIs, shared by the clients and the data plane
+    def __init__(self, latency=0.05, staging_delay=2, quota_scale=1):
+        self.latency = latency
+        self.staging_delay = staging_delay
+        self.quota_scale = quota_scale
+        self.regions = {}
+        self.quotas = {}
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._ids = itertools.count(1)
+
+    def new_id(self):
+        return f"{next(self._ids):010x}"
+
+    def quota(self, region, operation):
+        key = (region, operation)
+        if key not in self.quotas:
+            rate, burst = (
+                ACCOUNT_QUOTA
+                if operation is None
+                else OPERATION_QUOTAS.get(operation, ACCOUNT_QUOTA)
+            )
+            self.quotas[key] = Quota(rate * self.quota_scale, burst)
+        return self.quotas[key]
+
+    async def call(self, region, operation):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        self.calls[operation] += 1
+        account = self.quota(region, None)
+        quotas = [account]
+        if operation in OPERATION_QUOTAS:
+            quotas.append(self.quota(region, operation))
+        if not all([quota.refill() for quota in quotas]):
+            self.throttled[operation] += 1
+            raise error(operation, "TooManyRequestsException", "Too Many Requests", 429)
+        for quota in quotas:
+            quota.tokens -= 1
+
+    def apis(self, region):
+        return self.regions.setdefault(region, {})
+
+    def get_api(self, region, api_id, operation):
+        try:
+            return self.apis(region)[api_id]
+        except KeyError:
+            raise error(operation, "NotFoundException", "Invalid API identifier specified", 404)
+
+    def snapshot(self, api):
+        # What a deployment serves: the GET integration of every top level resource
+        return {
+            resource["pathPart"]: api["integrations"][(resource_id, "GET")]
+            for resource_id, resource in api["resources"].items()
+            if resource.get("parentId") == api["root"]
+            and (resource_id, "GET") in api["integrations"]
+        }
+
+
+class FakeApiGatewayClient:
+    def __init__(self, plane, region):
+        self.plane = plane
+        self.region = region
+
+    async def call(self, operation):
+        await self.plane.call(self.region, operation)
+
+    def api(self, api_id, operation):
+        return self.plane.get_api(self.region, api_id, operation)
+
+    async def get_rest_apis(self, limit=25, position=None):
+        await self.call("get_rest_apis")
+        apis = [
+            {"id": api_id, "name": api["name"]}
+            for api_id, api in self.plane.apis(self.region).items()
+        ]
+        return response(**page(apis, limit, position))
+
+    async def create_rest_api(self, name, **kwargs):
+        await self.call("create_rest_api")
+        api_id, root = self.plane.new_id(), self.plane.new_id()
+        self.plane.apis(self.region)[api_id] = {
+            "name": name,
+            "root": root,
+            "resources": {root: {"id": root, "path": "/"}},
+            "integrations": {},
+            "deployments": [],
+            "stages": {},
+        }
+        return response(id=api_id, name=name)
+
+    async def get_resources(self, restApiId, limit=25, position=None, embed=()):
+        await self.call("get_resources")
+        api = self.api(restApiId, "get_resources")
+        items = []
+        for resource_id, resource in api["resources"].items():
+            resource = dict(resource)
+            methods = {
+                method: {"httpMethod": method}
+                for (rid, method) in api["integrations"]
+                if rid == resource_id
+            }
+            if methods:
+                if "methods" in embed:
+                    for method in methods:
+                        methods[method]["methodIntegration"] = {
+                            "uri": api["integrations"][(resource_id, method)]
+                        }
+                resource["resourceMethods"] = methods
+            items.append(resource)
+        return response(**page(items, limit, position))
+
+    async def create_resource(self, restApiId, parentId, pathPart):
+        await self.call("create_resource")
+        api = self.api(restApiId, "create_resource")
+        parent = api["resources"][parentId]
+        path = parent["path"].rstrip("/") + "/" + pathPart
+        if any(resource["path"] == path for resource in api["resources"].values()):
+            raise error("create_resource", "ConflictException", "Another resource with the same parent already has this name", 409)
+
+        resource_id = self.plane.new_id()
+        api["resources"][resource_id] = {
+            "id": resource_id,
+            "parentId": parentId,
+            "pathPart": pathPart,
+            "path": path,
+        }
+        return response(**api["resources"][resource_id])
+
+    async def delete_resource(self, restApiId, resourceId):
+        await self.call("delete_resource")
+        api = self.api(restApiId, "delete_resource")
+
+        def drop(resource_id):
+            for child in [
+                r["id"]
+                for r in api["resources"].values()
+                if r.get("parentId") == resource_id
+            ]:
+                drop(child)
+            api["resources"].pop(resource_id, None)
+            for key in [key for key in api["integrations"] if key[0] == resource_id]:
+                del api["integrations"][key]
+
+        drop(resourceId)
+        return response()
+
+    async def put_method(self, restApiId, resourceId, httpMethod, **kwargs):
+        await self.call("put_method")
+        return response(httpMethod=httpMethod)
+
+    async def put_integration(self, restApiId, resourceId, httpMethod, uri, **kwargs):
+        await self.call("put_integration")
+        self.api(restApiId, "put_integration")["integrations"][
+            (resourceId, httpMethod)
+        ] = uri
+        return response(uri=uri)
+
+    async def get_integration(self, restApiId, resourceId, httpMethod):
+        await self.call("get_integration")
+        try:
+            uri = self.api(restApiId, "get_integration")["integrations"][
+                (resourceId, httpMethod)
+            ]
+        except KeyError:
+            raise error("get_integration", "NotFoundException", "Invalid Integration identifier specified", 404)
+        return response(uri=uri)
+
+    async def put_method_response(self, **kwargs):
+        await self.call("put_method_response")
+        return response()
+
+    async def put_integration_response(self, **kwargs):
+        await self.call("put_integration_response")
+        return response()
+
+    async def put_rest_api(self, restApiId, mode, body, **kwargs):
+        await self.call("put_rest_api")
+        api = self.api(restApiId, "put_rest_api")
+        by_path = {resource["path"]: resource for resource in api["resources"].values()}
+        for path, methods in json.loads(body)["paths"].items():
+            parent = api["resources"][api["root"]]
+            for part in path.strip("/").split("/"):
+                child = parent["path"].rstrip("/") + "/" + part
+                if child not in by_path:
+                    resource_id = self.plane.new_id()
+                    by_path[child] = api["resources"][resource_id] = {
+                        "id": resource_id,
+                        "parentId": parent["id"],
+                        "pathPart": part,
+                        "path": child,
+                    }
+                parent = by_path[child]
+
+            for method, spec in methods.items():
+                method = "ANY" if method == "x-amazon-apigateway-any-method" else method.upper()
+                api["integrations"][(parent["id"], method)] = spec[
+                    "x-amazon-apigateway-integration"
+                ]["uri"]
+        return response(id=restApiId)
+
+    async def get_deployments(self, restApiId, limit=25, position=None):
+        await self.call("get_deployments")
+        deployments = [
+            {"id": d["id"], "createdDate": d["createdDate"]}
+            for d in self.api(restApiId, "get_deployments")["deployments"]
+        ]
+        return response(**page(deployments, limit, position))
+
+    async def create_deployment(self, restApiId, stageName, **kwargs):
+        await self.call("create_deployment")
+        api = self.api(restApiId, "create_deployment")
+        deployment = {
+            "id": self.plane.new_id(),
+            "createdDate": datetime.datetime.now(datetime.timezone.utc),
+            # Propagating to the edge is what takes API Gateway 10-30 seconds
+            "live_at": time.monotonic() + self.plane.staging_delay,
+            "snapshot": self.plane.snapshot(api),
+        }
+        api["deployments"].append(deployment)
+        stage = api["stages"].setdefault(stageName, {"stageName": stageName})
+        stage["deploymentId"] = deployment["id"]
+        return response(id=deployment["id"], createdDate=deployment["createdDate"])
+
+    async def get_stage(self, restApiId, stageName):
+        await self.call("get_stage")
+        try:
+            stage = self.api(restApiId, "get_stage")["stages"][stageName]
+        except KeyError:
+            raise error("get_stage", "NotFoundException", "Invalid Stage identifier specified", 404)
+        return response(**stage)
+
+    async def get_stages(self, restApiId):
+        await self.call("get_stages")
+        return response(item=list(self.api(restApiId, "get_stages")["stages"].values()))
+
+    async def update_stage(self, restApiId, stageName, patchOperations):
+        await self.call("update_stage")
+        stage = self.api(restApiId, "update_stage")["stages"][stageName]
+        for operation in patchOperations:
+            if operation["path"].startswith("/variables/"):
+                variables = stage.setdefault("variables", {})
+                name = operation["path"].split("/", 2)[2]
+                if operation["op"] == "remove":
+                    variables.pop(name, None)
+                else:
+                    variables[name] = operation["value"]
+        return response(**stage)
+
+    async def delete_stage(self, restApiId, stageName):
+        await self.call("delete_stage")
+        self.api(restApiId, "delete_stage")["stages"].pop(stageName, None)
+        return response()
+
+    async def delete_rest_api(self, restApiId):
+        await self.call("delete_rest_api")
+        self.api(restApiId, "delete_rest_api")
+        del self.plane.apis(self.region)[restApiId]
+        return response()
+
+
+class FakeClientContext:
+    def __init__(self, client):
+        self.client = client
+
+    async def __aenter__(self):
+        return self.client
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class FakeSession:
+    # Stands in for aiobotocore's AioSession, assign it to AWSProxies.session before setup()
+    def __init__(self, plane):
+        self.plane = plane
+
+    def create_client(self, service, region_name=None, **kwargs):
+        return FakeClientContext(FakeApiGatewayClient(self.plane, region_name))
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class DataPlane:
+    # execute-api stand-in, answers like API Gateway does for deployments that haven't propagated yet.
+    # Doubles as the ReadinessChecker's HTTP client.
+    def __init__(self, plane):
+        self.plane = plane
+        self.requests = 0
+
+    def resolve(self, host, path):
+        # Returns (status code, headers, origin the request would've been proxied to)
+        parts = host.split(".")
+        if len(parts) < 3 or parts[1] != "execute-api":
+            return 502, {}, None
+
+        api = self.plane.apis(parts[2]).get(parts[0])
+        _, stage_name, path_part = (path.split("/") + ["", ""])[:3]
+        stage = api and api["stages"].get(stage_name)
+        if not stage:
+            return 403, {"x-amzn-ErrorType": "ForbiddenException"}, None
+
+        now = time.monotonic()
+        live = [d for d in api["deployments"] if d["live_at"] <= now]
+        uri = live[-1]["snapshot"].get(path_part) if live else None
+        if not uri:
+            return 403, {"x-amzn-ErrorType": "MissingAuthenticationTokenException"}, None
+
+        variables = stage.get("variables", {})
+        if any(name not in variables for name in STAGE_VARIABLE.findall(uri)):
+            return 500, {"x-amzn-ErrorType": "InternalServerErrorException"}, None
+        return 200, {}, STAGE_VARIABLE.sub(lambda m: variables[m.group(1)], uri)
+
+    async def head(self, url):
+        self.requests += 1
+        parts = urlsplit(url)
+        status_code, headers, _ = self.resolve(parts.hostname, parts.path)
+        return FakeResponse(status_code, headers)
+
+    get = head
@@ -1,15 +1,21 @@
 import re
 import sys
+import time
 import asyncio
 import random
 import logging
 import pathlib
-from mitmproxy import ctx
-from mitmproxy.script import concurrent
-from mitmproxy.net.http import Headers
-from urllib.parse import urlparse, urljoin
+import httpx
+from mitmproxy import ctx, http, exceptions
+from mitmproxy.net.http import http1
+from mitmproxy.utils import human
 from syncasync import async_to_sync
-from doubletap.aws import AWSProxies
+from doubletap.aws import AWSProxies, DEFAULT_PORTS, SHARD_CAPACITY, GC_INTERVAL
+from doubletap.registry import ProxyRegistry
+from doubletap.allowlist import AllowList
+from doubletap.selection import SELECTORS, RegionStickySelector
+from doubletap.health import HealthTracker, is_failure, is_gateway_failure
+from doubletap import metrics
 from doubletap.utils import USER_AGENTS, get_aws_credentials, gen_random_ip, get_entries, gen_urls_from_entries
 
 REGIONS = [
@@ -25,11 +31,46 @@ REGIONS = [
     "eu-north-1",
 ]
 
+RETRY_STATUS_CODES = [429, 502, 504]
+
+# API Gateway renames reserved headers it got from the backend, e.g. x-amzn-Remapped-Date
+REMAPPED_PREFIX = b"x-amzn-remapped-"
+# Framing headers describe the connection between API Gateway and us, the backend's ones are left remapped
+FRAMING_HEADERS = {b"content-length", b"transfer-encoding", b"connection"}
+
+REQUESTS = metrics.histogram(
+    "doubletap_request_seconds",
+    "Latency of requests proxied through API Gateway",
+    ("region",),
+)
+RESPONSES = metrics.counter(
+    "doubletap_responses_total",
+    "Responses that came back through API Gateway by status code, error for ones that never did",
+    ("region", "code"),
+)
+LOOKUPS = metrics.counter(
+    "doubletap_endpoint_lookups_total",
+    "Proxied requests by whether their host already had endpoints (hit) or had to wait for them (miss)",
+    ("result",),
+)
+INTERCEPTED = metrics.histogram(
+    "doubletap_intercept_seconds",
+    "Time requests to hosts without endpoints were held before being sent on or dropped",
+)
+
 
 class DoubleTap:
     def __init__(self):
         self.proxies = AWSProxies(regions=REGIONS)
-        self.allowed_regexes = []
+        self.selector = SELECTORS["random"]()
+        self.health = HealthTracker()
+        self.retry_client = httpx.AsyncClient(verify=False, timeout=30)
+        self.prestage_urls = []
+        self.allowlist = AllowList()
+        self.stream_threshold = None
+        self.random = random.Random()
+        self.identities = {}
+        self.metrics_server = None
 
     def load(self, loader):
         loader.add_option(
@@ -43,7 +84,15 @@ class DoubleTap:
             name="proxy_method",
             typespec=str,
             default="random",
-            help="Proxy method to use",
+            choices=list(SELECTORS),
+            help="How to pick the API Gateway endpoint each request gets sent through",
+        )
+
+        loader.add_option(
+            name="sticky_requests",
+            typespec=int,
+            default=0,
+            help="With the sticky proxy_method, move a client connection to another region after this many requests (0 to never rotate)",
         )
 
         loader.add_option(
@@ -60,83 +109,490 @@ class DoubleTap:
             help="URLs to prestage before starting the proxy",
         )
 
+        loader.add_option(
+            name="registry",
+            typespec=str,
+            default="~/.doubletap/registry.db",
+            help="File used to remember staged proxies between runs (empty to disable)",
+        )
+
+        loader.add_option(
+            name="max_pool_connections",
+            typespec=int,
+            default=50,
+            help="Maximum number of connections kept open to API Gateway in each region",
+        )
+
+        loader.add_option(
+            name="shard_capacity",
+            typespec=int,
+            default=SHARD_CAPACITY,
+            help="Maximum number of domains proxied through a single API Gateway API, more APIs get created per region as needed",
+        )
+
+        loader.add_option(
+            name="standby_pool",
+            typespec=int,
+            default=0,
+            help="Number of deployed endpoints kept on standby in every region so new https domains can be proxied without waiting on a deployment",
+        )
+
+        loader.add_option(
+            name="endpoint_ttl",
+            typespec=int,
+            default=0,
+            help="Delete proxies for domains that haven't been requested in this many seconds (0 to keep them forever)",
+        )
+
+        loader.add_option(
+            name="max_endpoints",
+            typespec=int,
+            default=0,
+            help="Maximum number of proxied domains, the least recently used ones get deleted past it (0 for no limit)",
+        )
+
+        loader.add_option(
+            name="staging_timeout",
+            typespec=int,
+            default=120,
+            help="Maximum number of seconds to wait for new proxies to go live before letting requests through",
+        )
+
+        loader.add_option(
+            name="ready_quorum",
+            typespec=int,
+            default=1,
+            help="Number of regions a new host's proxies have to be live in before its requests are let through, the other regions join as they go live (0 waits for all of them)",
+        )
+
+        loader.add_option(
+            name="metrics_port",
+            typespec=int,
+            default=0,
+            help="Serve Prometheus metrics on this port on localhost (0 to disable)",
+        )
+
+        loader.add_option(
+            name="breaker_cooldown",
+            typespec=int,
+            default=30,
+            help="Seconds an unhealthy region or endpoint is kept out of rotation before it gets probed again",
+        )
+
+        loader.add_option(
+            name="retry_throttled",
+            typespec=bool,
+            default=False,
+            help="Replay requests that were throttled (429) or failed at the gateway (502/504) through a different region",
+        )
+
+        loader.add_option(
+            name="retry_budget",
+            typespec=int,
+            default=2,
+            help="Maximum number of times a request gets replayed through a different region",
+        )
+
+        loader.add_option(
+            name="retry_methods",
+            typespec=str,
+            default="GET,HEAD",
+            help="Comma separated list of HTTP methods that are safe to replay",
+        )
+
+        loader.add_option(
+            name="identity_rotation",
+            typespec=str,
+            default="request",
+            choices=["request", "session"],
+            help="Whether the spoofed User-Agent and X-Forwarded-For IP change on every request or once per client connection",
+        )
+
+        loader.add_option(
+            name="identity_seed",
+            typespec=str,
+            default="",
+            help="Seed for the spoofed User-Agents and X-Forwarded-For IPs, makes them reproducible between runs (empty for random)",
+        )
+
+        loader.add_option(
+            name="stream_threshold",
+            typespec=str,
+            default="",
+            help="Stream response bodies bigger than this to the client instead of buffering them, understands k/m/g suffixes (empty to disable)",
+        )
+
     def configure(self, updates):
         if not all(get_aws_credentials()):
             ctx.log.error("AWS credentials not found, exiting.")
             sys.exit(1)
 
-        if ctx.options.cleanup:
-            cleanup = async_to_sync(self.proxies.cleanup)
-            cleanup()
+        if ctx.options.registry and not self.proxies.registry:
+            self.proxies.use_registry(ProxyRegistry(ctx.options.registry))
 
-        if ctx.options.allowlist:
-            for rx in get_entries(ctx.options.allowlist):
-                try:
-                    self.allowed_regexes.append(re.compile(rf"{rx}"))
-                except re.error as e:
-                    ctx.log.error(f"Regex '{rx}' failed to compile: {e}")
+        self.proxies.max_pool_connections = ctx.options.max_pool_connections
+        if ctx.options.shard_capacity < 1:
+            # reserve() would keep adding shards with no room in them forever
+            raise exceptions.OptionsError("shard_capacity has to be at least 1")
+        self.proxies.shard_capacity = ctx.options.shard_capacity
+        self.proxies.standby_size = ctx.options.standby_pool
+        self.proxies.readiness.timeout = ctx.options.staging_timeout
+        self.proxies.quorum = ctx.options.ready_quorum
 
-            ctx.log.info(f"Loaded {len(self.allowed_regexes)} allowlist entry(ies)")
+        if "proxy_method" in updates or "sticky_requests" in updates:
+            selector = SELECTORS[ctx.options.proxy_method]
+            self.selector = (
+                selector(ctx.options.sticky_requests)
+                if selector is RegionStickySelector
+                else selector()
+            )
+
+        if "breaker_cooldown" in updates:
+            self.health = HealthTracker(cooldown=ctx.options.breaker_cooldown)
 
-        setup = async_to_sync(self.proxies.setup)
-        setup()
+        if "identity_seed" in updates:
+            self.random = random.Random(ctx.options.identity_seed or None)
+            self.identities.clear()
+
+        if "stream_threshold" in updates:
+            try:
+                self.stream_threshold = (
+                    human.parse_size(ctx.options.stream_threshold)
+                    if ctx.options.stream_threshold
+                    else None
+                )
+            except ValueError as e:
+                raise exceptions.OptionsError(f"Invalid stream_threshold: {e}")
 
-        if ctx.options.prestage:
-            bulk_create = async_to_sync(self.proxies.bulk_create)
-            bulk_create(
+        if "allowlist" in updates:
+            self.allowlist = AllowList()
+            if ctx.options.allowlist:
+                for rx in get_entries(ctx.options.allowlist):
+                    try:
+                        self.allowlist.add(rx)
+                    except re.error as e:
+                        ctx.log.error(f"Regex '{rx}' failed to compile: {e}")
+
+                self.allowlist.compile()
+                ctx.log.info(f"Loaded {len(self.allowlist)} allowlist entry(ies)")
+
+        if "prestage" in updates and ctx.options.prestage:
+            self.prestage_urls = list(
                 gen_urls_from_entries(
                     get_entries(ctx.options.prestage)
                 )
             )
 
-    async def redirect(self, flow, proxy_urls):
-        proxy_url = random.choice(proxy_urls)
-        ctx.log.info(f"Redirecting request to {proxy_url}")
+    async def startup(self):
+        try:
+            if ctx.options.cleanup:
+                await self.proxies.cleanup()
 
-        flow.request.url = (
-            proxy_url
-            if flow.request.path == "/"
-            else urljoin(proxy_url, flow.request.path[1:])
-        )
-        flow.request.host = urlparse(proxy_url).netloc
-        flow.request.headers["User-Agent"] = random.choice(USER_AGENTS)
-        flow.request.headers["X-My-X-Forwarded-For"] = gen_random_ip()
+            await self.proxies.setup()
+            ctx.log.info("DOUBLETAP is ready, proxying traffic")
 
-        flow.resume()
+            await self.proxies.verify()
 
-    async def proxy_request(self, flow):
-        proxy_urls = await self.proxies.create(
-            f"{flow.request.scheme}://{flow.request.host}/"
-        )
-        await self.redirect(flow, proxy_urls)
+            if self.prestage_urls:
+                ctx.log.info(f"Prestaging {len(self.prestage_urls)} URL(s) in the background")
+                await self.proxies.bulk_create(self.prestage_urls)
+                ctx.log.info("Finished prestaging")
+
+            self.proxies.replenish()
+        except Exception as e:
+            ctx.log.error(f"DOUBLETAP startup failed: {e}")
+
+    async def collect_garbage(self):
+        while True:
+            await asyncio.sleep(GC_INTERVAL)
+            try:
+                await self.proxies.recover()
+            except Exception as e:
+                ctx.log.error(f"Retrying degraded regions failed: {e}")
+
+            if not ctx.options.endpoint_ttl and not ctx.options.max_endpoints:
+                continue
+
+            try:
+                evicted = await self.proxies.evict(
+                    ttl=ctx.options.endpoint_ttl, capacity=ctx.options.max_endpoints
+                )
+                self.health.forget(evicted)
+            except Exception as e:
+                ctx.log.error(f"Evicting idle proxies failed: {e}")
+
+    def running(self):
+        # Setup runs in the background so known hosts can be proxied right away,
+        # flows for everything else wait for their proxies to get created
+        asyncio.ensure_future(self.startup())
+        asyncio.ensure_future(self.collect_garbage())
+        if ctx.options.metrics_port:
+            asyncio.ensure_future(self.serve_metrics(ctx.options.metrics_port))
+
+    async def serve_metrics(self, port):
+        try:
+            self.metrics_server = await metrics.serve("127.0.0.1", port)
+            ctx.log.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+        except OSError as e:
+            ctx.log.error(f"Failed to serve metrics on port {port}: {e}")
+
+    def get_origin(self, flow):
+        # Built in the same shape as the index keys so known hosts don't need any URL parsing
+        request = flow.request
+        if request.port == DEFAULT_PORTS.get(request.scheme):
+            return f"{request.scheme}://{request.host}/"
+        return f"{request.scheme}://{request.host}:{request.port}/"
+
+    def gen_identity(self):
+        return self.random.choice(USER_AGENTS), gen_random_ip(self.random)
+
+    def get_identity(self, flow):
+        if ctx.options.identity_rotation != "session":
+            return self.gen_identity()
+
+        client_id = flow.client_conn.id
+        if client_id not in self.identities:
+            self.identities[client_id] = self.gen_identity()
+        return self.identities[client_id]
+
+    def redirect(self, flow, endpoints):
+        endpoint = self.selector.select(flow, self.health.filter(endpoints))
+        ctx.log.info(f"Redirecting request to {endpoint.proxy_url}")
+
+        self.selector.started(endpoint)
+        self.health.started(endpoint)
+        flow.metadata["doubletap"] = {
+            "endpoint": endpoint,
+            "endpoints": endpoints,
+            "started": time.monotonic(),
+        }
+
+        request = flow.request
+        request.scheme = "https"
+        request.port = 443
+        request.host = endpoint.host
+        request.path = endpoint.path + request.path[1:]
+        user_agent, ip = self.get_identity(flow)
+        flow.request.headers["User-Agent"] = user_agent
+        flow.request.headers["X-My-X-Forwarded-For"] = ip
+
+    async def proxy_request(self, flow, origin, intercepted):
+        endpoints = await self.proxies.create(origin)
+        INTERCEPTED.observe(time.monotonic() - intercepted)
+        if not endpoints:
+            ctx.log.error(f"No proxies available for {flow.request.host}, dropping request")
+            flow.kill()
+            return
+
+        self.redirect(flow, endpoints)
+        flow.resume()
 
     def request(self, flow):
-        if self.allowed_regexes:
-            for rx in self.allowed_regexes:
-                if rx.findall(f"{flow.request.scheme}://{flow.request.host}/"):
-                    break
-            else:
-                return flow
+        if self.allowlist and not self.allowlist.allowed(
+            flow.request.scheme, flow.request.host
+        ):
+            return flow
 
         ctx.log.debug(f"Processing URL: {flow.request.url}")
+        origin = self.get_origin(flow)
+        endpoints = self.proxies.get(origin)
+        if endpoints:
+            LOOKUPS.inc(result="hit")
+            self.redirect(flow, endpoints)
+            return
+
+        # Only hosts we haven't got endpoints for yet have to wait on the event loop
+        LOOKUPS.inc(result="miss")
         flow.intercept()
-        asyncio.create_task(self.proxy_request(flow))
+        asyncio.create_task(self.proxy_request(flow, origin, time.monotonic()))
+
+    def request_finished(self, flow):
+        # error() can still fire after response(), every attempt only gets counted once
+        started = flow.metadata.get("doubletap", {}).pop("started", None)
+        if started is None:
+            return
+
+        endpoint = flow.metadata["doubletap"]["endpoint"]
+        elapsed = time.monotonic() - started if flow.response else None
+        self.selector.finished(endpoint, elapsed)
+        if flow.response:
+            REQUESTS.observe(elapsed, region=endpoint.region)
+            RESPONSES.inc(region=endpoint.region, code=flow.response.status_code)
+        else:
+            RESPONSES.inc(region=endpoint.region, code="error")
+        self.health.record(
+            endpoint,
+            not flow.response
+            or is_failure(flow.response.status_code, flow.response.headers),
+            not flow.response
+            or is_gateway_failure(flow.response.status_code, flow.response.headers),
+            elapsed,
+        )
+
+    def should_retry(self, flow, retries):
+        return (
+            retries < ctx.options.retry_budget
+            and flow.response.status_code in RETRY_STATUS_CODES
+            and flow.request.method.upper()
+            in [m.strip().upper() for m in ctx.options.retry_methods.split(",")]
+        )
+
+    async def retry(self, flow):
+        try:
+            await self.replay(flow)
+        except Exception as e:
+            ctx.log.error(f"Retrying {flow.request.url} failed: {e}")
+        finally:
+            self.remap_headers(flow)
+            flow.resume()
+
+    async def replay(self, flow):
+        retries = 0
+        tried = set()
+        while "doubletap" in flow.metadata and self.should_retry(flow, retries):
+            endpoint = flow.metadata["doubletap"]["endpoint"]
+            tried.add(endpoint.region)
+            if not flow.request.url.startswith(endpoint.proxy_url):
+                return
+
+            candidates = [
+                e
+                for e in self.health.filter(flow.metadata["doubletap"]["endpoints"])
+                if e.region not in tried
+            ]
+            if not candidates:
+                return
+
+            retries += 1
+            retry_endpoint = self.selector.select(flow, candidates)
+            retry_proxy_url = retry_endpoint.proxy_url
+            ctx.log.info(
+                f"Got a {flow.response.status_code} through {endpoint.proxy_url}, retrying through {retry_proxy_url}"
+            )
+
+            flow.request.url = (
+                retry_proxy_url + flow.request.url[len(endpoint.proxy_url) :]
+            )
+            self.selector.started(retry_endpoint)
+            self.health.started(retry_endpoint)
+            flow.metadata["doubletap"]["endpoint"] = retry_endpoint
+            flow.metadata["doubletap"]["started"] = time.monotonic()
+
+            try:
+                async with self.retry_client.stream(
+                    flow.request.method,
+                    flow.request.url,
+                    headers=[
+                        (k, v)
+                        for k, v in flow.request.headers.fields
+                        if k.lower() not in (b"host", b"content-length")
+                    ],
+                    content=flow.request.raw_content,
+                    allow_redirects=False,
+                ) as r:
+                    flow.response = http.HTTPResponse.make(
+                        r.status_code,
+                        b"".join([chunk async for chunk in r.aiter_raw()]),
+                        r.headers.raw,
+                    )
+            except httpx.HTTPError as e:
+                ctx.log.warn(f"Retrying through {retry_proxy_url} failed: {e}")
+                flow.metadata["doubletap"].pop("started")
+                self.selector.finished(retry_endpoint)
+                RESPONSES.inc(region=retry_endpoint.region, code="error")
+                self.health.record(retry_endpoint, True, True)
+                return
+
+            self.request_finished(flow)
+
+    def remap_headers(self, flow):
+        fields = flow.response.headers.fields
+        remapped = {
+            k[len(REMAPPED_PREFIX) :].lower()
+            for k, _ in fields
+            if k[: len(REMAPPED_PREFIX)].lower() == REMAPPED_PREFIX
+        } - FRAMING_HEADERS
+        if not remapped:
+            return
+
+        # The backend's original headers win over the ones API Gateway set in their place,
+        # repeated headers like Set-Cookie are kept as they are
+        flow.response.headers.fields = tuple(
+            (k[len(REMAPPED_PREFIX) :], v)
+            if k[len(REMAPPED_PREFIX) :].lower() in remapped
+            and k[: len(REMAPPED_PREFIX)].lower() == REMAPPED_PREFIX
+            else (k, v)
+            for k, v in fields
+            if k.lower() not in remapped
+        )
+
+    def will_retry(self, flow):
+        return (
+            ctx.options.retry_throttled
+            and "doubletap" in flow.metadata
+            and self.should_retry(flow, 0)
+        )
+
+    def should_stream(self, flow):
+        if self.stream_threshold is None or flow.response.stream:
+            return False
+
+        # Responses we might replay have to be buffered, those are error pages anyway
+        if self.will_retry(flow):
+            return False
+
+        try:
+            expected_size = http1.expected_http_body_size(flow.request, flow.response)
+        except exceptions.HttpException:
+            return False
+
+        # Chunked bodies (no size) and ones read until the connection closes (negative size) could be any
+        # length, those get streamed too
+        return (
+            expected_size is None
+            or expected_size < 0
+            or expected_size > self.stream_threshold
+        )
+
+    def responseheaders(self, flow):
+        # The body gets read the way API Gateway framed it, so that's decided on its own headers
+        if self.should_stream(flow):
+            ctx.log.debug(f"Streaming response from {flow.request.host}")
+            flow.response.stream = True
+
+        # Headers have to be fixed up before a streamed response starts going out to the client
+        self.remap_headers(flow)
 
-    @concurrent
     def response(self, flow):
-        remapped_headers = {}
-        for k, v in flow.response.headers.items():
-            header = k
-            if k.lower().startswith("x-amzn-remapped"):
-                # header = '-'.join(map(lambda x: x.title(), k.split('-',3)[-1].split('-')))
-                header = k.split("-", 3)[-1]
+        self.request_finished(flow)
+        if self.will_retry(flow):
+            # Replays go out on the event loop, the flow is held until they're done
+            flow.intercept()
+            asyncio.create_task(self.retry(flow))
+
+    def error(self, flow):
+        self.request_finished(flow)
 
-            remapped_headers[header.encode()] = v.encode()
+    def clientdisconnect(self, layer):
+        self.selector.disconnected(layer.client_conn.id)
+        self.identities.pop(layer.client_conn.id, None)
 
-        # ctx.log.debug(beautify_json(remapped_headers))
-        flow.response.headers = Headers(remapped_headers.items())
+    async def close(self):
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        await self.proxies.close()
+        await self.retry_client.aclose()
 
     def done(self):
+        try:
+            close = async_to_sync(self.close)
+            close()
+        except Exception as e:
+            ctx.log.debug(f"Failed to close AWS clients: {e}")
+
+        if self.proxies.registry:
+            self.proxies.registry.close()
         ctx.log.info("DOUBLETAP exiting...")
 
 
@@ -0,0 +1,49 @@
+import re
+import logging
+from functools import lru_cache
+
+log = logging.getLogger("doubletap.allowlist")
+
+CACHE_SIZE = 8192
+
+UNMERGEABLE = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)")
+
+
+class AllowList:
+    def __init__(self, patterns=(), cache_size=CACHE_SIZE):
+        self.patterns = []
+        self.regexes = []
+        self.allowed = lru_cache(maxsize=cache_size)(self._match)
+
+        for pattern in patterns:
+            self.add(pattern)
+        self.compile()
+
+    def add(self, pattern):
+        # Compiled on its own first so a broken entry gets reported instead of breaking the whole list
+        re.compile(rf"{pattern}")
+        self.patterns.append(pattern)
+
+    def compile(self):
+        self.allowed.cache_clear()
+
+        # Named groups, group references and global flags don't survive being merged into one regex,
+        # those get matched on their own
+        merged = [p for p in self.patterns if not UNMERGEABLE.search(p)]
+        self.regexes = [re.compile(rf"{p}") for p in self.patterns if UNMERGEABLE.search(p)]
+        if merged:
+            try:
+                self.regexes.insert(
+                    0, re.compile("|".join(f"(?:{pattern})" for pattern in merged))
+                )
+            except re.error as e:
+                log.debug(f"Couldn't merge the allowlist ({e}), matching every regex on its own")
+                self.regexes[:0] = [re.compile(rf"{p}") for p in merged]
+        log.debug(f"Compiled {len(self.patterns)} allowlist regex(es) into {len(self.regexes)}")
+
+    def _match(self, scheme, host):
+        url = f"{scheme}://{host}/"
+        return any(rx.search(url) for rx in self.regexes)
+
+    def __len__(self):
+        return len(self.patterns)
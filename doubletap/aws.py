@@ -1,14 +1,92 @@
+import re
+import sys
+import time
 import asyncio
 import logging
+import functools
 import aiobotocore
 import httpx
 import json
+import itertools
+from collections import Counter, namedtuple
 from contextlib import AsyncExitStack
+from urllib.parse import urlsplit
+from aiobotocore.config import AioConfig
 from botocore.exceptions import ClientError
+from doubletap.ratelimit import (
+    INTERACTIVE,
+    PRESTAGE,
+    BACKGROUND,
+    get_rate_limiter,
+    prioritize,
+    priority,
+)
+from doubletap.readiness import ReadinessChecker
+from doubletap import metrics
 from doubletap.utils import get_aws_credentials, gen_random_string, beautify_json
 
 log = logging.getLogger("doubletap.aws")
 
+# Amount of URLs imported per put_rest_api call, keeps the request body well under the API Gateway limit
+BULK_BATCH_SIZE = 100
+
+# Seconds to wait for concurrent endpoint creations to pile up before deploying them together
+DEPLOY_WINDOW = 0.5
+
+MAX_POOL_CONNECTIONS = 50
+
+# API Gateway allows 300 resources per API by default, every proxied host takes two of them and the root takes one
+SHARD_CAPACITY = 145
+
+# Maximum page size of API Gateway's list operations
+PAGE_SIZE = 500
+
+# Standby endpoints proxy to whatever host their stage variable points to, so claiming one doesn't need a redeployment.
+# Stage variables can't change the scheme of an integration URI, the pool only serves https hosts.
+STAGE_VARIABLE = re.compile(r"\$\{stageVariables\.(\w+)\}")
+
+# Seconds between garbage collections of idle proxies, hosts used more recently than this are never evicted
+GC_INTERVAL = 60
+# Degraded regions are retried after 1, 2, 4, ... garbage collections, and given up on after this many failures
+MAX_RECOVERIES = 5
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+PROVISIONING = metrics.histogram(
+    "doubletap_provision_seconds",
+    "Time spent in every phase of bringing up proxy endpoints",
+    ("region", "phase"),
+)
+DEGRADED = metrics.counter(
+    "doubletap_degraded_total",
+    "Proxy endpoints that failed to get created",
+    ("region",),
+)
+
+# Tuples have no per instance __dict__, so holding one of these per region for tens of thousands of hosts stays cheap
+# host and path are kept split out so flows can be rewritten without parsing proxy_url
+ProxyEndpoint = namedtuple(
+    "ProxyEndpoint",
+    ["region", "api_id", "resource_id", "path_part", "host", "path", "proxy_url"],
+)
+
+
+def get_standby_variable(path_part):
+    return f"s_{path_part}"
+
+
+def normalize_origin(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ""
+    if ":" in host:
+        host = f"[{host}]"
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+
+    # Interned so the region maps and the central index share a single copy of every URL
+    return sys.intern(f"{scheme}://{host}/")
+
 
 class AWSProxierError(Exception):
     pass
@@ -26,36 +104,170 @@ class AWSApiResponse:
 
 
 def apiresponse(func):
-    async def wrapper(*args, **kwargs):
-        return AWSApiResponse(await func(*args, **kwargs)).response
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        return AWSApiResponse(
+            await self.limiter.call(func.__name__, func, self, *args, **kwargs)
+        ).response
 
     return wrapper
 
 
+def gen_openapi_document(name, endpoints):
+    def integration(http_method, uri, request_params, cache_key_params=[]):
+        return {
+            "type": "http_proxy",
+            "httpMethod": http_method,
+            "uri": uri,
+            "passthroughBehavior": "when_no_match",
+            "requestParameters": request_params,
+            "cacheKeyParameters": cache_key_params,
+            "responses": {"default": {"statusCode": "200"}},
+        }
+
+    header_param = {
+        "name": "X-My-X-Forwarded-For",
+        "in": "header",
+        "required": False,
+        "type": "string",
+    }
+    proxy_param = {"name": "proxy", "in": "path", "required": True, "type": "string"}
+
+    paths = {}
+    for endpoint, url in endpoints.items():
+        # the endpoint resource itself has no {proxy} path parameter, the importer refuses to map one
+        main_method = {
+            "parameters": [header_param],
+            "responses": {"200": {"description": "200 response"}},
+        }
+        paths[f"/{endpoint}"] = {
+            "get": {
+                **main_method,
+                "x-amazon-apigateway-integration": integration(
+                    "GET",
+                    url,
+                    {
+                        "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
+                    },
+                ),
+            },
+            "post": {
+                **main_method,
+                "x-amazon-apigateway-integration": integration(
+                    "POST",
+                    url,
+                    {
+                        "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
+                    },
+                ),
+            },
+        }
+        paths[f"/{endpoint}/{{proxy+}}"] = {
+            "x-amazon-apigateway-any-method": {
+                "parameters": [proxy_param, header_param],
+                "responses": {"200": {"description": "200 response"}},
+                "x-amazon-apigateway-integration": integration(
+                    "ANY",
+                    url + "{proxy}" if "{proxy}" not in url else url,
+                    {
+                        "integration.request.path.proxy": "method.request.path.proxy",
+                        "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For",
+                    },
+                    ["method.request.path.proxy"],
+                ),
+            }
+        }
+
+    return {
+        "swagger": "2.0",
+        "info": {"title": name, "version": "1.0"},
+        "schemes": ["https"],
+        "paths": paths,
+    }
+
+
+class DeploymentScheduler:
+    def __init__(self, deploy, window=DEPLOY_WINDOW):
+        self.deploy = deploy
+        self.window = window
+        self._pending = None
+        self._priority = None
+        self._lock = None
+
+    async def request(self):
+        if not self._pending:
+            self._pending = asyncio.get_event_loop().create_future()
+            self._priority = priority.get()
+            asyncio.ensure_future(self._run(self._pending))
+        else:
+            # A deployment shared with prestaging shouldn't hold up a live request
+            self._priority = min(self._priority, priority.get())
+
+        return await asyncio.shield(self._pending)
+
+    async def _run(self, future):
+        await asyncio.sleep(self.window)
+
+        if not self._lock:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            # Anything requested from here on needs a deployment that starts after it
+            self._pending = None
+            try:
+                with prioritize(self._priority):
+                    future.set_result(await self.deploy())
+            except Exception as e:
+                future.set_exception(e)
+
+
 class AWSApiGateway:
     def __init__(self, name, region="us-east-2"):
         self.name = name
         self.region = region
         self.log = logging.getLogger(f"doubletap.aws.apigateway.{region}")
+        self.limiter = get_rate_limiter(region)
 
         self.id = None
         self.client = None
+        self.session = None
+        self.config = None
         self.aws_access_key = None
         self.aws_secret_key = None
 
         self.aws_access_key, self.aws_secret_key = get_aws_credentials()
         self._exit_stack = AsyncExitStack()
+        self._loop = None
+        self._lock = None
+        self._id_lock = None
         # self.region = boto3.session.Session().region_name
 
     async def get_id(self):
-        if not self.id:
-            api = await self.create()
-            self.id = api["id"]
+        # Concurrent callers on an API that doesn't exist yet would otherwise each create one
+        async with self._id_lock:
+            if not self.id:
+                api = await self.create()
+                self.id = api["id"]
         return self.id
 
+    async def paginate(self, operation, **kwargs):
+        items = []
+        while True:
+            page = await self.limiter.call(
+                operation, getattr(self.client, operation), limit=PAGE_SIZE, **kwargs
+            )
+            items.extend(page.get("items", []))
+            if not page.get("position"):
+                return items
+            kwargs["position"] = page["position"]
+
     async def create(self):
         api = await self.get_by_name(self.name)
-        return api if api else await self.client.create_rest_api(name=self.name)
+        if api:
+            return api
+        return await self.limiter.call(
+            "create_rest_api", self.client.create_rest_api, name=self.name
+        )
 
     async def get_resource_by_path(self, path):
         r = await self.get_resources()
@@ -83,17 +295,25 @@ class AWSApiGateway:
             if api["name"] == name:
                 return api
 
-    @apiresponse
     async def get(self):
-        return await self.client.get_rest_apis()
+        return await self.paginate("get_rest_apis")
+
+    async def get_resources(self, embed=()):
+        kwargs = {"embed": list(embed)} if embed else {}
+        return await self.paginate("get_resources", restApiId=self.id, **kwargs)
+
+    async def get_deployments(self):
+        return await self.paginate("get_deployments", restApiId=self.id)
 
     @apiresponse
-    async def get_resources(self):
-        return await self.client.get_resources(restApiId=self.id)
+    async def get_stage(self, stage_name):
+        return await self.client.get_stage(restApiId=self.id, stageName=stage_name)
 
     @apiresponse
-    async def get_deployments(self):
-        return await self.client.get_deployments(restApiId=self.id)
+    async def update_stage(self, stage_name, patch_operations):
+        return await self.client.update_stage(
+            restApiId=self.id, stageName=stage_name, patchOperations=patch_operations
+        )
 
     @apiresponse
     async def get_stages(self):
@@ -166,6 +386,15 @@ class AWSApiGateway:
             statusCode=str(status_code),
         )
 
+    @apiresponse
+    async def import_api(self, document):
+        return await self.client.put_rest_api(
+            restApiId=self.id,
+            mode="merge",
+            failOnWarnings=False,
+            body=json.dumps(document).encode(),
+        )
+
     @apiresponse
     async def create_deployment(self, name, description=""):
         return await self.client.create_deployment(
@@ -198,32 +427,128 @@ class AWSApiGateway:
     async def delete_api(self):
         return await self.client.delete_rest_api(restApiId=self.id,)
 
-    async def __aenter__(self):
-        session = aiobotocore.session.AioSession()
-        self.client = await self._exit_stack.enter_async_context(
-            session.create_client(
-                "apigateway",
-                region_name=self.region,
-                aws_access_key_id=self.aws_access_key,
-                aws_secret_access_key=self.aws_secret_key,
-            )
-        )
+    async def open(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # The client's connection pool is bound to the event loop it was opened on
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._id_lock = asyncio.Lock()
+            self.client = None
+
+        async with self._lock:
+            if not self.client:
+                if not self.session:
+                    self.session = aiobotocore.session.AioSession()
+
+                self._exit_stack = AsyncExitStack()
+                self.client = await self._exit_stack.enter_async_context(
+                    self.session.create_client(
+                        "apigateway",
+                        region_name=self.region,
+                        aws_access_key_id=self.aws_access_key,
+                        aws_secret_access_key=self.aws_secret_key,
+                        config=self.config,
+                    )
+                )
+                self.log.debug("Opened API Gateway client")
 
         return self
 
+    async def close(self):
+        if self.client:
+            self.client = None
+            await self._exit_stack.aclose()
+
+    async def __aenter__(self):
+        return await self.open()
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._exit_stack.__aexit__(exc_type, exc_val, exc_tb)
+        # The client is long lived and shared, it only gets closed by close()
+        pass
 
 
 class AWSApiGatewayProxy:
-    def __init__(self, name, region="us-east-2"):
+    def __init__(self, name, region="us-east-2", deploy_window=DEPLOY_WINDOW):
         self.name = name
         self.region = region
-        self.proxies = {}
+        self.endpoints = {}
+        # (resource_id, path_part) of deployed endpoints that haven't been pointed at a host yet
+        self.standby = []
+        # Path parts of claimed standby endpoints, pointed at their host through a stage variable
+        self.variables = set()
+        # Registry rows of endpoints the next deployment will contain, the registry only lists deployed ones
+        self.unstaged = []
+        self.deployment_id = None
+        self.registry = None
         self.apigw = AWSApiGateway(name, region=region)
+        self.deployments = DeploymentScheduler(self.stage, window=deploy_window)
         self.log = logging.getLogger(f"doubletap.aws.apigatewayproxy.{region}")
 
-    async def create(self, url, endpoint):
+    def get_host(self):
+        return sys.intern(f"{self.apigw.id}.execute-api.{self.apigw.region}.amazonaws.com")
+
+    def get_proxy_url(self, path_part):
+        return f"https://{self.get_host()}/{self.name}/{path_part}/"
+
+    def add_endpoint(self, url, resource_id, path_part):
+        host = self.get_host()
+        path = f"/{self.name}/{path_part}/"
+        endpoint = ProxyEndpoint(
+            self.region,
+            self.apigw.id,
+            resource_id,
+            path_part,
+            host,
+            path,
+            f"https://{host}{path}",
+        )
+        self.endpoints[normalize_origin(url)] = endpoint
+        return endpoint
+
+    def record(self, *row):
+        if self.registry:
+            self.unstaged.append(row)
+
+    def discard_unstaged(self, path_part):
+        # Rows are (method, api_id, ..., path_part)
+        self.unstaged = [row for row in self.unstaged if row[-1] != path_part]
+
+    def load(self):
+        api = self.registry.get_api(self.name, self.region)
+        if not api:
+            return False
+
+        self.apigw.id, self.deployment_id = api
+        for url, resource_id, path_part in self.registry.get_endpoints(self.apigw.id):
+            self.add_endpoint(url, resource_id, path_part)
+        self.standby = self.registry.get_standby(self.apigw.id)
+        self.variables = self.registry.get_variables(self.apigw.id)
+
+        self.log.debug(
+            f"Loaded {len(self.endpoints)} proxy(ies) from registry (deployment: {self.deployment_id})"
+        )
+        return True
+
+    async def verify(self):
+        async with self.apigw as apigw_client:
+            api = await apigw_client.get_by_name(self.name)
+            if api and api["id"] == self.apigw.id:
+                # The stage points at the latest deployment, one call instead of paging through their history
+                try:
+                    stage = await apigw_client.get_stage(self.name)
+                except ClientError:
+                    stage = {}
+                if stage.get("deploymentId") == self.deployment_id:
+                    self.log.debug("Registry is up to date")
+                    return self.endpoints
+
+            self.log.debug("Registry is stale, rediscovering staged proxies")
+            self.apigw.id = None
+
+        return await self.get()
+
+    async def create(self, url, endpoint, retries=3):
         async with self.apigw as apigw_client:
             await apigw_client.get_id()
 
@@ -238,123 +563,319 @@ class AWSApiGatewayProxy:
                 main_resource_id = main_resource["id"]
             except ClientError as e:
                 self.log.error(f"botocore.exceptions.ClientError: {e}")
-                if "ConflictException" in e.args[0]:
+                if "ConflictException" in e.args[0] and retries:
                     self.log.warning("Resource conflict detected, attempting overwrite")
                     await self.delete(endpoint)
-                    return await self.create(url, endpoint)
+                    return await self.create(url, endpoint, retries - 1)
                 self.log.error(f"Unhandled botocore.exceptions.ClientError: {e}")
             else:
-                self.log.debug(
-                    f"Attempting to create proxy to {url} => endpoint: {endpoint}"
-                )
+                try:
+                    self.log.debug(
+                        f"Attempting to create proxy to {url} => endpoint: {endpoint}"
+                    )
 
-                # you don't even want to know how long it took me to figure out that you need to pass "method.request.path.proxy" to put_method first
-                # *before* calling put_integration with that value in the request_params. where dafuq are the docs on this???
-                await apigw_client.create_method(
-                    resource_id=main_resource_id,
-                    http_method="GET",
-                    request_params={
-                        "method.request.path.proxy": True,
-                        "method.request.header.X-My-X-Forwarded-For": False
-                        # "method.request.header.X-My-X-Amzn-Apigateway-Api-Id": False
-                    },
-                )
+                    # you don't even want to know how long it took me to figure out that you need to pass "method.request.path.proxy" to put_method first
+                    # *before* calling put_integration with that value in the request_params. where dafuq are the docs on this???
+                    await apigw_client.create_method(
+                        resource_id=main_resource_id,
+                        http_method="GET",
+                        request_params={
+                            "method.request.path.proxy": True,
+                            "method.request.header.X-My-X-Forwarded-For": False
+                            # "method.request.header.X-My-X-Amzn-Apigateway-Api-Id": False
+                        },
+                    )
 
-                await apigw_client.create_integration(
-                    resource_id=main_resource_id,
-                    http_method="GET",
-                    type="HTTP_PROXY",
-                    uri=url,
-                    request_params={
-                        "integration.request.path.proxy": "method.request.path.proxy",
-                        "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
-                        # "integration.request.header.X-Amzn-Apigateway-Api-Id": "method.request.header.X-My-X-Amzn-Apigateway-Api-Id"
-                    },
-                    cache_key_params=["method.request.path.proxy"],
-                )
+                    await apigw_client.create_integration(
+                        resource_id=main_resource_id,
+                        http_method="GET",
+                        type="HTTP_PROXY",
+                        uri=url,
+                        request_params={
+                            "integration.request.path.proxy": "method.request.path.proxy",
+                            "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
+                            # "integration.request.header.X-Amzn-Apigateway-Api-Id": "method.request.header.X-My-X-Amzn-Apigateway-Api-Id"
+                        },
+                        cache_key_params=["method.request.path.proxy"],
+                    )
 
-                await apigw_client.create_method(
-                    resource_id=main_resource_id,
-                    http_method="POST",
-                    request_params={
-                        "method.request.path.proxy": True,
-                        "method.request.header.X-My-X-Forwarded-For": False
-                        # "method.request.header.X-My-X-Amzn-Apigateway-Api-Id": False
-                    },
-                )
+                    await apigw_client.create_method(
+                        resource_id=main_resource_id,
+                        http_method="POST",
+                        request_params={
+                            "method.request.path.proxy": True,
+                            "method.request.header.X-My-X-Forwarded-For": False
+                            # "method.request.header.X-My-X-Amzn-Apigateway-Api-Id": False
+                        },
+                    )
 
-                await apigw_client.create_integration(
-                    resource_id=main_resource_id,
-                    http_method="POST",
-                    type="HTTP_PROXY",
-                    uri=url,
-                    request_params={
-                        "integration.request.path.proxy": "method.request.path.proxy",
-                        "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
-                        # "integration.request.header.X-Amzn-Apigateway-Api-Id": "method.request.header.X-My-X-Amzn-Apigateway-Api-Id"
-                    },
-                    cache_key_params=["method.request.path.proxy"],
-                )
+                    await apigw_client.create_integration(
+                        resource_id=main_resource_id,
+                        http_method="POST",
+                        type="HTTP_PROXY",
+                        uri=url,
+                        request_params={
+                            "integration.request.path.proxy": "method.request.path.proxy",
+                            "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
+                            # "integration.request.header.X-Amzn-Apigateway-Api-Id": "method.request.header.X-My-X-Amzn-Apigateway-Api-Id"
+                        },
+                        cache_key_params=["method.request.path.proxy"],
+                    )
 
-                proxy_resource = await apigw_client.create_resource(
-                    main_resource_id, "{proxy+}"
-                )
-                proxy_resource_id = proxy_resource["id"]
-                await apigw_client.create_method(
-                    resource_id=proxy_resource_id,
-                    http_method="ANY",
-                    request_params={
-                        "method.request.path.proxy": True,
-                        "method.request.header.X-My-X-Forwarded-For": False
-                        # "method.request.header.X-My-X-Amzn-Apigateway-Api-Id": False
-                    },
+                    proxy_resource = await apigw_client.create_resource(
+                        main_resource_id, "{proxy+}"
+                    )
+                    proxy_resource_id = proxy_resource["id"]
+                    await apigw_client.create_method(
+                        resource_id=proxy_resource_id,
+                        http_method="ANY",
+                        request_params={
+                            "method.request.path.proxy": True,
+                            "method.request.header.X-My-X-Forwarded-For": False
+                            # "method.request.header.X-My-X-Amzn-Apigateway-Api-Id": False
+                        },
+                    )
+
+                    await apigw_client.create_integration(
+                        resource_id=proxy_resource_id,
+                        http_method="ANY",
+                        type="HTTP_PROXY",
+                        uri=url + "{proxy}" if "{proxy}" not in url else url,
+                        request_params={
+                            "integration.request.path.proxy": "method.request.path.proxy",
+                            "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
+                            # "integration.request.header.X-Amzn-Apigateway-Api-Id": "method.request.header.X-My-X-Amzn-Apigateway-Api-Id"
+                        },
+                        cache_key_params=["method.request.path.proxy"],
+                    )
+                except Exception:
+                    # Isn't in self.endpoints yet, nothing else would ever delete it
+                    try:
+                        await apigw_client.delete_resource(main_resource_id)
+                    except ClientError as e:
+                        self.log.warning(
+                            f"Failed to delete partially created endpoint {endpoint}: {e}"
+                        )
+                    raise
+
+                proxy_endpoint = self.add_endpoint(url, main_resource_id, endpoint)
+                self.record(
+                    "add_endpoint", self.apigw.id, url, self.region, main_resource_id, endpoint
                 )
+                return proxy_endpoint
 
-                await apigw_client.create_integration(
-                    resource_id=proxy_resource_id,
-                    http_method="ANY",
-                    type="HTTP_PROXY",
-                    uri=url + "{proxy}" if "{proxy}" not in url else url,
-                    request_params={
-                        "integration.request.path.proxy": "method.request.path.proxy",
-                        "integration.request.header.X-Forwarded-For": "method.request.header.X-My-X-Forwarded-For"
-                        # "integration.request.header.X-Amzn-Apigateway-Api-Id": "method.request.header.X-My-X-Amzn-Apigateway-Api-Id"
-                    },
-                    cache_key_params=["method.request.path.proxy"],
+    async def import_endpoints(self, endpoints):
+        async with self.apigw as apigw_client:
+            await apigw_client.get_id()
+
+            items = list(endpoints.items())
+            for i in range(0, len(items), BULK_BATCH_SIZE):
+                batch = dict(items[i : i + BULK_BATCH_SIZE])
+                self.log.debug(
+                    f"Importing {len(batch)} proxy(ies) into {self.name} (API id: {self.apigw.id})"
                 )
+                await apigw_client.import_api(gen_openapi_document(self.name, batch))
+
+            return {r["path"]: r["id"] for r in await apigw_client.get_resources()}
+
+    def gen_path_parts(self, count):
+        path_parts = set()
+        while len(path_parts) < count:
+            path_parts.add(gen_random_string())
+        return path_parts
 
-                proxy_url = f"https://{self.apigw.id}.execute-api.{self.apigw.region}.amazonaws.com/{self.name}/{endpoint}/"
-                self.proxies[url] = proxy_url
-                return proxy_url
+    async def bulk_create(self, urls):
+        endpoints = dict(zip(self.gen_path_parts(len(urls)), urls))
+        resources = await self.import_endpoints(endpoints)
+
+        created = {}
+        for endpoint, url in endpoints.items():
+            resource_id = resources.get(f"/{endpoint}")
+            if not resource_id:
+                self.log.error(f"Imported proxy to {url} => endpoint: {endpoint} not found")
+                continue
+
+            created[url] = self.add_endpoint(url, resource_id, endpoint)
+            self.record(
+                "add_endpoint", self.apigw.id, url, self.region, resource_id, endpoint
+            )
+
+        return created
+
+    async def create_standby(self, count):
+        endpoints = {
+            path_part: f"https://${{stageVariables.{get_standby_variable(path_part)}}}/"
+            for path_part in self.gen_path_parts(count)
+        }
+        resources = await self.import_endpoints(endpoints)
+
+        created = []
+        for path_part in endpoints:
+            resource_id = resources.get(f"/{path_part}")
+            if not resource_id:
+                self.log.error(f"Imported standby endpoint {path_part} not found")
+                continue
+
+            created.append((resource_id, path_part))
+            self.record(
+                "add_standby", self.apigw.id, self.region, resource_id, path_part
+            )
+
+        return created
+
+    async def claim(self, url, slot):
+        resource_id, path_part = slot
+        async with self.apigw as apigw_client:
+            await apigw_client.update_stage(
+                self.name,
+                [
+                    {
+                        "op": "replace",
+                        "path": f"/variables/{get_standby_variable(path_part)}",
+                        "value": url.split("://", 1)[1].rstrip("/"),
+                    }
+                ],
+            )
+
+        self.variables.add(path_part)
+        self.log.debug(f"Pointed standby endpoint {path_part} at {url}")
+        if self.registry:
+            self.registry.claim_standby(
+                self.apigw.id, url, self.region, resource_id, path_part
+            )
+        return self.add_endpoint(url, resource_id, path_part)
 
     async def stage(self):
         self.log.debug("Staging and deploying API")
+        # Anything created while the deployment is underway waits for the next one
+        unstaged, self.unstaged = self.unstaged, []
+        try:
+            async with self.apigw as apigw_client:
+                deployment = await apigw_client.create_deployment(self.name)
+                # apigw_client.create_stage(deployment_id, self.name)
+        except BaseException:
+            self.unstaged = unstaged + self.unstaged
+            raise
+
+        self.deployment_id = deployment["id"]
+        if self.registry:
+            for method, *args in unstaged:
+                getattr(self.registry, method)(*args)
+            self.registry.set_api(
+                self.name, self.region, self.apigw.id, self.deployment_id
+            )
+        return self.deployment_id
+
+    async def get_stage_deployment_id(self):
         async with self.apigw as apigw_client:
-            await apigw_client.create_deployment(self.name)
-            # apigw_client.create_stage(deployment_id, self.name)
+            try:
+                stage = await apigw_client.get_stage(self.name)
+            except ClientError:
+                return None
+
+        return stage.get("deploymentId")
 
     async def get(self):
         async with self.apigw as apigw_client:
             await apigw_client.get_id()
 
-            for resource in await apigw_client.get_resources():
-                try:
-                    integration = await apigw_client.get_integration(
-                        resource["id"], "GET"
-                    )
-                    url = integration["uri"]
-                except:
+            try:
+                stage = await apigw_client.get_stage(self.name)
+            except ClientError:
+                stage = {}
+            variables = stage.get("variables", {})
+
+            # Integrations come embedded in the resource pages, so discovery costs a request per page and not per resource
+            resources = await apigw_client.get_resources(embed=["methods"])
+            uris = await asyncio.gather(
+                *[self.get_uri(apigw_client, resource) for resource in resources]
+            )
+
+            self.endpoints, self.standby, self.variables = {}, [], set()
+            self.unstaged = []
+            for resource, url in zip(resources, uris):
+                if not url:
                     continue
-                self.proxies[
-                    url
-                ] = f"https://{self.apigw.id}.execute-api.{self.apigw.region}.amazonaws.com/{self.name}/{resource['pathPart']}/"
 
-            if self.proxies:
+                variable = STAGE_VARIABLE.search(url)
+                if variable:
+                    if variable.group(1) not in variables:
+                        self.standby.append((resource["id"], resource["pathPart"]))
+                        continue
+                    url = STAGE_VARIABLE.sub(lambda m: variables[m.group(1)], url)
+                    self.variables.add(resource["pathPart"])
+
+                self.add_endpoint(url, resource["id"], resource["pathPart"])
+
+            if self.endpoints:
                 self.log.debug(
-                    f"Retrieved already staged proxies: {beautify_json(self.proxies)}"
+                    f"Retrieved already staged proxies: {beautify_json({url: e.proxy_url for url, e in self.endpoints.items()})}"
+                )
+
+            self.deployment_id = stage.get("deploymentId")
+
+        if self.registry:
+            self.registry.replace(
+                self.name,
+                self.region,
+                self.apigw.id,
+                self.deployment_id,
+                [
+                    (url, e.resource_id, e.path_part)
+                    for url, e in self.endpoints.items()
+                ],
+                self.standby,
+                self.variables,
+            )
+
+        return self.endpoints
+
+    async def get_uri(self, apigw_client, resource):
+        method = resource.get("resourceMethods", {}).get("GET")
+        if method is None:
+            return None
+
+        integration = method.get("methodIntegration")
+        if integration is None:
+            # Lookups for anything that didn't come embedded run concurrently, bounded by the region's rate limiter
+            try:
+                integration = await apigw_client.get_integration(resource["id"], "GET")
+            except ClientError:
+                return None
+        return integration.get("uri")
+
+    async def remove(self, endpoint):
+        self.discard_unstaged(endpoint.path_part)
+        if self.registry:
+            self.registry.remove_endpoint(self.apigw.id, endpoint.path_part)
+
+        # Takes the {proxy+} child resource with it
+        async with self.apigw as apigw_client:
+            await apigw_client.delete_resource(endpoint.resource_id)
+
+            # Stage variables outlive their resource, they'd pile up on the stage with every evicted standby endpoint
+            if endpoint.path_part in self.variables:
+                await apigw_client.update_stage(
+                    self.name,
+                    [
+                        {
+                            "op": "remove",
+                            "path": f"/variables/{get_standby_variable(endpoint.path_part)}",
+                        }
+                    ],
                 )
+                self.variables.discard(endpoint.path_part)
 
-            return self.proxies
+    async def remove_standby(self, slots):
+        for _, path_part in slots:
+            self.discard_unstaged(path_part)
+            if self.registry:
+                self.registry.remove_endpoint(self.apigw.id, path_part)
+
+        async with self.apigw as apigw_client:
+            await asyncio.gather(
+                *[apigw_client.delete_resource(resource_id) for resource_id, _ in slots]
+            )
 
     async def delete(self, endpoint):
         async with self.apigw as apigw_client:
@@ -362,6 +883,10 @@ class AWSApiGatewayProxy:
             resource_id = resource["id"]
             await apigw_client.delete_resource(resource_id)
 
+        self.discard_unstaged(endpoint)
+        if self.registry:
+            self.registry.remove_endpoint(self.apigw.id, endpoint)
+
     async def unstage(self):
         async with self.apigw as apigw_client:
             await apigw_client.get_id()
@@ -372,85 +897,593 @@ class AWSApiGatewayProxy:
             await apigw_client.get_id()
             await apigw_client.delete_api()
 
+        self.apigw.id = None
+        self.endpoints.clear()
+        self.standby.clear()
+        self.variables.clear()
+        self.unstaged.clear()
+        if self.registry:
+            self.registry.forget(self.name, self.region)
+
     def __getitem__(self, value):
-        return self.proxies.get(value)
+        return self.endpoints.get(value)
 
     def __iter__(self):
-        for k, v in self.proxies.items():
+        for k, v in self.endpoints.items():
             yield k, v
 
 
 class AWSProxies:
-    def __init__(self, regions, name="DOUBLETAP"):
+    def __init__(
+        self,
+        regions,
+        name="DOUBLETAP",
+        deploy_window=DEPLOY_WINDOW,
+        shard_capacity=SHARD_CAPACITY,
+    ):
         self.name = name
         self.regions = regions
-        self.proxies = [AWSApiGatewayProxy(name, region=region) for region in regions]
+        self.deploy_window = deploy_window
+        self.shard_capacity = shard_capacity
+        # Standby endpoints kept deployed in every region, ready to be claimed by new https hosts
+        self.standby_size = 0
+        # Regions a new host has to be live in before create() returns, 0 waits for all of them
+        self.quorum = 0
+        self.shard_name = re.compile(rf"{re.escape(name)}-(\d+)")
+        # Region => ids of APIs older versions created under the plain name, only cleanup() touches them
+        self.legacy = {}
+        # Every region spreads its hosts over APIs named {name}-0 to {name}-N
+        self.shards = {region: [] for region in regions}
+        self.proxies = []
+        self.registry = None
+        self.session = None
+        self.config = None
+        # Normalized target origin => tuple of endpoints in every region it's staged in
+        self.index = {}
+        self.last_used = {}
+        # Normalized target origin => {region its endpoint couldn't be created in: (failures, next retry)}
+        self.degraded = {}
+        self.max_pool_connections = MAX_POOL_CONNECTIONS
+        self.ready = asyncio.Event()
+        self._unverified = []
+        self._reserved = Counter()
+        # Normalized target origin => shards still bringing up its endpoint, kept out of the index until they're done
+        self._pending = {}
+        self._replenishing = None
         self._httpx_client = httpx.AsyncClient(verify=False, http2=True)
+        self.readiness = ReadinessChecker(self._httpx_client)
         self._creation_events = {}
 
-    async def is_proxy_available_for_url(self, url):
-        return all(filter(lambda p: p[url], self.proxies))
+        for region in regions:
+            self.add_shard(region)
 
-    async def setup(self):
-        log.debug("Retrieving already staged proxies, please wait...")
-        await asyncio.gather(*[proxy.get() for proxy in self.proxies])
+    def use_registry(self, registry):
+        self.registry = registry
         for proxy in self.proxies:
-            for url, _ in proxy:
+            proxy.registry = registry
+
+    def add_shard(self, region):
+        shards = self.shards[region]
+        proxy = AWSApiGatewayProxy(
+            f"{self.name}-{len(shards)}", region=region, deploy_window=self.deploy_window
+        )
+        proxy.registry = self.registry
+        proxy.apigw.session = self.session
+        proxy.apigw.config = self.config
+        shards.append(proxy)
+        self.proxies.append(proxy)
+        return proxy
+
+    def get_shard(self, region, name):
+        match = self.shard_name.fullmatch(name)
+        if not match:
+            return None
+
+        index = int(match.group(1))
+        while len(self.shards[region]) <= index:
+            self.add_shard(region)
+        return self.shards[region][index]
+
+    def reserve(self, region, urls):
+        # Fills up the shards in order, a new API only gets created once all the others are full.
+        # Returns the (shard, urls) pairs to create, the caller has to release() them afterwards.
+        assignments = []
+        while urls:
+            proxy = next(
+                (p for p in self.shards[region] if self.free(p) > 0), None
+            ) or self.add_shard(region)
+            chunk, urls = urls[: self.free(proxy)], urls[self.free(proxy) :]
+            self._reserved[proxy] += len(chunk)
+            assignments.append((proxy, chunk))
+        return assignments
+
+    def release(self, proxy, urls):
+        self._reserved[proxy] -= len(urls)
+
+    def free(self, proxy):
+        return (
+            self.shard_capacity
+            - len(proxy.endpoints)
+            - len(proxy.standby)
+            - self._reserved[proxy]
+        )
+
+    def get(self, url):
+        # Already normalized origins, which is what the hot path passes in, skip the parsing
+        endpoints = self.index.get(url)
+        if endpoints is None:
+            url = normalize_origin(url)
+            endpoints = self.index.get(url)
+        if endpoints:
+            self.last_used[url] = time.monotonic()
+        return endpoints
+
+    def is_proxy_available_for_url(self, url):
+        return len(self.index.get(normalize_origin(url), ())) == len(self.regions)
+
+    def reindex(self, urls=None):
+        if urls is None:
+            urls = {url for proxy in self.proxies for url in proxy.endpoints}
+            self.index = {}
+
+        now = time.monotonic()
+        for url in urls:
+            pending = self._pending.get(url, ())
+            endpoints = tuple(
+                proxy.endpoints[url]
+                for proxy in self.proxies
+                if url in proxy.endpoints and proxy not in pending
+            )
+            if endpoints:
+                self.index[url] = endpoints
+                self.last_used.setdefault(url, now)
+            else:
+                self.index.pop(url, None)
+                self.last_used.pop(url, None)
+
+    def _set_created(self):
+        self.reindex()
+        for url in self.index:
+            if url not in self._creation_events:
                 self._creation_events[url] = asyncio.Event()
                 self._creation_events[url].set()
 
+    async def open(self):
+        if not self.session:
+            self.session = aiobotocore.session.AioSession()
+
+        # Throttling is retried by the rate limiter, botocore retrying on its own would hold on to the limiter's
+        # slots and hide the throttling from it
+        self.config = AioConfig(
+            max_pool_connections=self.max_pool_connections, retries={"max_attempts": 0}
+        )
+        for proxy in self.proxies:
+            proxy.apigw.session = self.session
+            proxy.apigw.config = self.config
+
+        await asyncio.gather(*[proxy.apigw.open() for proxy in self.proxies])
+
+    async def close(self):
+        # A standby top up still running would otherwise go on with closed clients
+        if self._replenishing:
+            self._replenishing.cancel()
+        await asyncio.gather(
+            *[proxy.apigw.close() for proxy in self.proxies], return_exceptions=True
+        )
+        await self._httpx_client.aclose()
+
+    async def discover(self, region):
+        # Shards are looked up by name so ones missing from the registry get picked up as well.
+        # Returns the shards that weren't known before.
+        async with self.shards[region][0].apigw as apigw_client:
+            apis = await apigw_client.get()
+
+        self.legacy[region] = [api["id"] for api in apis if api["name"] == self.name]
+        found = []
+        for api in apis:
+            proxy = self.get_shard(region, api["name"])
+            if proxy and not proxy.apigw.id:
+                proxy.apigw.id = api["id"]
+                found.append(proxy)
+        return found
+
+    async def setup(self):
+        try:
+            await self.open()
+
+            if self.registry:
+                for region in self.regions:
+                    for name, _, _ in self.registry.get_apis(region):
+                        self.get_shard(region, name)
+                self._unverified = [proxy for proxy in self.proxies if proxy.load()]
+
+            missing = [
+                region
+                for region in self.regions
+                if not any(proxy in self._unverified for proxy in self.shards[region])
+            ]
+            if missing:
+                log.debug("Retrieving already staged proxies, please wait...")
+                found = await asyncio.gather(
+                    *[self.discover(region) for region in missing]
+                )
+                await asyncio.gather(
+                    *[proxy.get() for proxy in itertools.chain(*found)]
+                )
+
+            self._set_created()
+        finally:
+            # Don't leave flows waiting on a setup that blew up
+            self.ready.set()
+
+    async def verify(self):
+        if not self._unverified:
+            return
+
+        with prioritize(BACKGROUND):
+            log.debug("Verifying proxy registry against AWS in the background")
+            unverified, self._unverified = self._unverified, []
+            await asyncio.gather(*[proxy.verify() for proxy in unverified])
+
+            found = await asyncio.gather(
+                *[self.discover(region) for region in {p.region for p in unverified}]
+            )
+            await asyncio.gather(*[proxy.get() for proxy in itertools.chain(*found)])
+            self._set_created()
+
     async def cleanup(self):
+        await self.open()
+
         log.debug("Unstaging and destroying DOUBLETAP proxies, please wait...")
-        await asyncio.gather(*[proxy.unstage() for proxy in self.proxies])
-        await asyncio.gather(*[proxy.destroy() for proxy in self.proxies])
+        await asyncio.gather(*[self.discover(region) for region in self.regions])
+
+        # APIs from before sharding don't belong to any shard, nothing else would ever remove them
+        legacy = []
+        for region, ids in self.legacy.items():
+            for api_id in ids:
+                proxy = AWSApiGatewayProxy(self.name, region=region)
+                proxy.registry = self.registry
+                proxy.apigw.session = self.session
+                proxy.apigw.config = self.config
+                proxy.apigw.id = api_id
+                legacy.append(proxy)
+        self.legacy = {}
+
+        doomed = [proxy for proxy in self.proxies if proxy.apigw.id] + legacy
+        try:
+            # Shards that never got deployed have no stage to delete
+            await asyncio.gather(
+                *[proxy.unstage() for proxy in doomed], return_exceptions=True
+            )
+            await asyncio.gather(*[proxy.destroy() for proxy in doomed])
+        finally:
+            await asyncio.gather(
+                *[proxy.apigw.close() for proxy in legacy], return_exceptions=True
+            )
+
+        if self.registry:
+            for region in self.regions:
+                for name, _, _ in self.registry.get_apis(region):
+                    if name == self.name or self.shard_name.fullmatch(name):
+                        self.registry.forget(name, region)
+
+        for region in self.regions:
+            del self.shards[region][1:]
+        self.proxies = [shards[0] for shards in self.shards.values()]
+        self.reindex()
+
+    async def create(self, url, priority=INTERACTIVE, regions=None):
+        url = normalize_origin(url)
+        await self.ready.wait()
 
-    async def create(self, url):
         if url not in self._creation_events:
             self._creation_events[url] = asyncio.Event()
         else:
             await self._creation_events[url].wait()
 
-        proxy_urls = [proxy[url] for proxy in self.proxies]
-        if all(proxy_urls):
-            return proxy_urls
+        pending = self._pending.get(url, ())
+        missing = [
+            region
+            for region in regions or self.regions
+            if not any(
+                url in proxy.endpoints or proxy in pending
+                for proxy in self.shards[region]
+            )
+        ]
+        # Regions that got their endpoint since they failed aren't degraded anymore
+        degraded = self.degraded.get(url, {})
+        for region in [
+            r for r in degraded if any(url in p.endpoints for p in self.shards[r])
+        ]:
+            del degraded[region]
+        if url in self.degraded and not degraded:
+            del self.degraded[url]
+
+        if not missing:
+            self.last_used[url] = time.monotonic()
+            return self.index.get(url, ())
 
         log.debug(f"Creating proxy endpoints for {url}")
-        proxy_urls = await asyncio.gather(
-            *[proxy.create(url, gen_random_string()) for proxy in self.proxies]
-        )
+        joins = []
+        # Every region's work runs in its own task, which inherits the priority
+        with prioritize(priority):
+            for region in missing:
+                proxy = url.startswith("https://") and next(
+                    (p for p in self.shards[region] if p.standby), None
+                )
+                if proxy:
+                    joining = self.claim(url, proxy, proxy.standby.pop())
+                else:
+                    proxy = self.reserve(region, [url])[0][0]
+                    joining = self.provision(url, proxy)
+                self._pending.setdefault(url, set()).add(proxy)
+                joins.append(asyncio.ensure_future(self.join(url, proxy, joining)))
+
+        # Flows get released once enough regions are live, the rest keep going and join the rotation when done
+        quorum = min(self.quorum or len(joins), len(joins))
+        live = 0
+        try:
+            for joined in asyncio.as_completed(joins):
+                live += await joined
+                if live >= quorum:
+                    break
+        finally:
+            self._creation_events[url].set()
 
-        await asyncio.wait([proxy.stage() for proxy in self.proxies], timeout=10)
-        await asyncio.gather(*[self.check_if_staged(url) for url in proxy_urls])
+        return self.index.get(url, ())
 
-        self._creation_events[url].set()
+    async def join(self, url, proxy, joining):
+        try:
+            live = await joining
+        except Exception as e:
+            log.warning(
+                f"Creating a proxy endpoint for {url} in {proxy.region} failed, marking the region as degraded: {e}"
+            )
+            self.degrade(url, proxy.region)
+            return False
+        else:
+            regions = self.degraded.get(url)
+            if regions:
+                regions.pop(proxy.region, None)
+                if not regions:
+                    del self.degraded[url]
+            return live
+        finally:
+            self._pending[url].discard(proxy)
+            if not self._pending[url]:
+                del self._pending[url]
+            self.reindex([url])
+
+    async def provision(self, url, proxy):
+        try:
+            with PROVISIONING.time(region=proxy.region, phase="create"):
+                endpoint = await proxy.create(url, gen_random_string())
+        finally:
+            self.release(proxy, [url])
+        if not endpoint:
+            raise AWSProxierError(f"{proxy.name} didn't create an endpoint")
+
+        with PROVISIONING.time(region=proxy.region, phase="deploy"):
+            deployment_id = await proxy.deployments.request()
+        # Endpoints that didn't show up live in time still get used, they just don't count towards the quorum
+        with PROVISIONING.time(region=proxy.region, phase="ready"):
+            return await self.readiness.wait(proxy, deployment_id, endpoint.proxy_url)
+
+    async def claim(self, url, proxy, slot):
+        # Standby endpoints are already deployed, they only have to be pointed at the host
+        try:
+            with PROVISIONING.time(region=proxy.region, phase="claim"):
+                await proxy.claim(url, slot)
+        except Exception:
+            proxy.standby.append(slot)
+            raise
+        finally:
+            self.replenish()
+        return True
+
+    def degrade(self, url, region):
+        regions = self.degraded.setdefault(url, {})
+        failures = regions.get(region, (0, 0))[0] + 1
+        regions[region] = (failures, time.monotonic() + GC_INTERVAL * 2 ** (failures - 1))
+        DEGRADED.inc(region=region)
+        if failures > MAX_RECOVERIES:
+            log.warning(f"Giving up on {url} in {region} after {failures} failed attempts")
+
+    async def recover(self):
+        # Hosts that came up without some of their regions get another shot at them, backing off every time it fails
+        now = time.monotonic()
+        due = {}
+        for url, regions in self.degraded.items():
+            for region, (failures, retry_at) in regions.items():
+                if failures <= MAX_RECOVERIES and retry_at <= now:
+                    due.setdefault(url, []).append(region)
+        if not due:
+            return
+
+        log.info(f"Retrying degraded regions for {len(due)} proxy(ies)")
+        await asyncio.gather(
+            *[self.create(url, BACKGROUND, regions) for url, regions in due.items()]
+        )
 
-        return proxy_urls
+    def replenish(self):
+        if self.standby_size and (
+            not self._replenishing or self._replenishing.done()
+        ):
+            self._replenishing = asyncio.ensure_future(self.fill_standby())
+
+    async def fill_standby(self):
+        # Loops since endpoints can get claimed while the pool is being topped up
+        with prioritize(BACKGROUND):
+            while True:
+                assignments = []
+                for region in self.regions:
+                    missing = self.standby_size - sum(
+                        len(proxy.standby) for proxy in self.shards[region]
+                    )
+                    if missing > 0:
+                        assignments += self.reserve(region, list(range(missing)))
 
-    async def bulk_create(self, urls):
-        await asyncio.gather(*[self.create(url) for url in urls])
+                if not assignments:
+                    return
 
-    async def check_if_staged(self, url):
-        log.debug(f"Checking if API has staged ({url})")
-        while True:
-            r = await self._httpx_client.get(url)
-            if r.status_code != 403 and not r.headers.get("x-amzn-ErrorType"):
                 log.debug(
-                    "API seems to have staged, reason: response status code was not 403 or 'x-amzn-ErrorType' header not present"
+                    f"Creating {sum(len(slots) for _, slots in assignments)} standby endpoint(s)"
+                )
+                results = await asyncio.gather(
+                    *[self.provision_standby(proxy, slots) for proxy, slots in assignments],
+                    return_exceptions=True,
                 )
-                return True
+                errors = [result for result in results if isinstance(result, Exception)]
+                if errors:
+                    log.error(f"Creating standby endpoints failed: {errors[0]}")
+                    return
 
+    async def provision_standby(self, proxy, slots):
+        try:
+            created = await proxy.create_standby(len(slots))
+            deployment_id = await proxy.deployments.request()
+            if created and not await self.readiness.wait(
+                proxy, deployment_id, proxy.get_proxy_url(created[0][1])
+            ):
+                # Only claimable once they're live, ones that never were would just take up room in the API
+                await proxy.remove_standby(created)
+                raise AWSProxierError(
+                    f"Standby endpoints in {proxy.name} ({proxy.region}) didn't go live"
+                )
+            proxy.standby.extend(created)
+        finally:
+            self.release(proxy, slots)
+
+    async def bulk_create(self, urls, priority=PRESTAGE):
+        urls = [
+            url
+            for url in dict.fromkeys(map(normalize_origin, urls))
+            if url not in self._creation_events
+        ]
+        if not urls:
+            return
+
+        for url in urls:
+            self._creation_events[url] = asyncio.Event()
+
+        log.debug(f"Bulk creating proxy endpoints for {len(urls)} URL(s)")
+        assignments = [
+            assignment
+            for region in self.regions
+            for assignment in self.reserve(region, urls)
+        ]
+        for proxy, chunk in assignments:
+            for url in chunk:
+                self._pending.setdefault(url, set()).add(proxy)
+        provisioned = 0
+        # Every host gets released to the flows waiting on it once it reached its quorum, like create() does
+        regions = Counter(url for _, chunk in assignments for url in chunk)
+        live, done = Counter(), Counter()
+
+        async def provision(proxy, chunk):
+            nonlocal provisioned
+            endpoints, ready = {}, False
             try:
-                data = r.json()
-                if data["message"] in ["Forbidden", "Missing Authentication Token"]:
-                    await asyncio.sleep(0.1)
-                    continue
-            except json.JSONDecodeError:
-                log.debug(
-                    "API seems to have staged, reason: response failed to decode to JSON"
+                try:
+                    with PROVISIONING.time(region=proxy.region, phase="import"):
+                        endpoints = await proxy.bulk_create(chunk)
+                finally:
+                    self.release(proxy, chunk)
+                with PROVISIONING.time(region=proxy.region, phase="deploy"):
+                    deployment_id = await proxy.deployments.request()
+
+                provisioned += 1
+                log.info(
+                    f"Deployed {len(endpoints)} proxy(ies) to {proxy.name} in {proxy.region} ({provisioned}/{len(assignments)} APIs)"
                 )
-                return True
-            except IndexError:
-                log.debug(
-                    "API seems to have staged, reason: returned JSON doesn't have 'message' key"
+
+                if endpoints:
+                    with PROVISIONING.time(region=proxy.region, phase="ready"):
+                        ready = await self.readiness.wait(
+                            proxy, deployment_id, next(iter(endpoints.values())).proxy_url
+                        )
+            except Exception as e:
+                log.warning(
+                    f"Creating {len(chunk)} proxy endpoint(s) in {proxy.region} failed, marking the region as degraded for them: {e}"
                 )
-                return True
+                for url in chunk:
+                    self.degrade(url, proxy.region)
+            finally:
+                # Every API joins the rotation for its chunk as soon as it's live
+                for url in chunk:
+                    self._pending[url].discard(proxy)
+                    if not self._pending[url]:
+                        del self._pending[url]
+                self.reindex(chunk)
+
+                for url in chunk:
+                    done[url] += 1
+                    live[url] += ready and url in endpoints
+                    quorum = min(self.quorum or regions[url], regions[url])
+                    if live[url] >= quorum or done[url] == regions[url]:
+                        self._creation_events[url].set()
+
+        with prioritize(priority):
+            try:
+                await asyncio.gather(
+                    *[provision(proxy, chunk) for proxy, chunk in assignments]
+                )
+            finally:
+                # Cancelled or not, nothing should be left waiting
+                for url in urls:
+                    self._creation_events[url].set()
+
+    async def evict(self, ttl=0, capacity=0):
+        if not self.ready.is_set():
+            return []
+
+        now = time.monotonic()
+        idle = sorted(
+            (self.last_used[url], url)
+            for url in self.index
+            if now - self.last_used[url] >= GC_INTERVAL
+            and self._creation_events[url].is_set()
+            and url not in self._pending
+        )
+
+        victims = [url for last_used, url in idle if ttl and now - last_used >= ttl]
+        excess = len(self.index) - len(victims) - capacity
+        if capacity and excess > 0:
+            # Least recently used first
+            evicted = set(victims)
+            victims += [url for _, url in idle if url not in evicted][:excess]
+
+        if not victims:
+            return []
+
+        log.info(f"Evicting {len(victims)} idle proxy(ies)")
+        removals = []
+        for url in victims:
+            # Dropped from every map before anything is awaited, requests for these hosts from now on recreate them
+            del self.index[url]
+            del self.last_used[url]
+            del self._creation_events[url]
+            self.degraded.pop(url, None)
+            for proxy in self.proxies:
+                endpoint = proxy.endpoints.pop(url, None)
+                if endpoint:
+                    removals.append((proxy, endpoint))
+
+        with prioritize(BACKGROUND):
+            results = await asyncio.gather(
+                *[proxy.remove(endpoint) for proxy, endpoint in removals],
+                return_exceptions=True,
+            )
+            for (proxy, endpoint), result in zip(removals, results):
+                if isinstance(result, Exception):
+                    log.warning(
+                        f"Failed to delete {endpoint.proxy_url} from {proxy.name} in {proxy.region}: {result}"
+                    )
+
+            # One redeployment per API for the whole batch so the deleted endpoints go away on the stage too
+            touched = {proxy for proxy, _ in removals}
+            await asyncio.gather(
+                *[proxy.deployments.request() for proxy in touched], return_exceptions=True
+            )
+
+        return [endpoint for _, endpoint in removals]
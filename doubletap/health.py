@@ -0,0 +1,139 @@
+import time
+import logging
+
+log = logging.getLogger("doubletap.health")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+def is_failure(status_code, headers):
+    return (
+        status_code == 429 or status_code >= 500 or "x-amzn-ErrorType" in headers
+    )
+
+
+def is_gateway_failure(status_code, headers):
+    # Throttling and errors API Gateway answered with itself, 5xx passed through from the target don't count
+    return status_code == 429 or "x-amzn-ErrorType" in headers
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        threshold=0.5,
+        min_requests=10,
+        cooldown=30,
+        max_cooldown=600,
+        alpha=0.1,
+        probes=3,
+    ):
+        self.name = name
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.alpha = alpha
+        self.probes = probes
+
+        self.state = CLOSED
+        self.error_rate = 0.0
+        self.latency = None
+        self.requests = 0
+        self.successes = 0
+        # Requests in flight while half-open
+        self.probing = 0
+        self.opened_at = 0
+
+    def available(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            log.info(f"{self.name} cooled down, probing it again")
+            self.state = HALF_OPEN
+            self.successes = 0
+            self.probing = 0
+        if self.state == HALF_OPEN:
+            # Only a few probes at a time until they closed the breaker or one of them reopened it
+            return self.probing < self.probes
+        return self.state != OPEN
+
+    def started(self):
+        if self.state == HALF_OPEN:
+            self.probing += 1
+
+    def record(self, failed, elapsed=None):
+        if elapsed is not None:
+            self.latency = (
+                elapsed
+                if self.latency is None
+                else self.latency + self.alpha * (elapsed - self.latency)
+            )
+
+        if self.state == HALF_OPEN:
+            self.probing = max(0, self.probing - 1)
+            if failed:
+                self.trip(min(self.max_cooldown, self.cooldown * 2))
+            else:
+                self.successes += 1
+                if self.successes >= self.probes:
+                    log.info(f"{self.name} is healthy again")
+                    self.state = CLOSED
+                    self.cooldown = self.base_cooldown
+                    self.error_rate = 0.0
+                    self.requests = 0
+            return
+
+        self.requests += 1
+        self.error_rate += self.alpha * (float(failed) - self.error_rate)
+        if (
+            self.state == CLOSED
+            and self.requests >= self.min_requests
+            and self.error_rate >= self.threshold
+        ):
+            self.trip(self.base_cooldown)
+
+    def trip(self, cooldown):
+        log.warning(
+            f"{self.name} is unhealthy (error rate: {self.error_rate:.0%}), taking it out of rotation for {cooldown}s"
+        )
+        self.state = OPEN
+        self.cooldown = cooldown
+        self.opened_at = time.monotonic()
+
+
+class HealthTracker:
+    def __init__(self, cooldown=30):
+        self.cooldown = cooldown
+        self.breakers = {}
+
+    def breaker(self, name):
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(name, cooldown=self.cooldown)
+        return self.breakers[name]
+
+    def available(self, endpoint):
+        return (
+            self.breaker(endpoint.region).available()
+            and self.breaker(endpoint.proxy_url).available()
+        )
+
+    def filter(self, endpoints):
+        # If everything is unhealthy there's nothing better to send traffic to
+        return [
+            endpoint for endpoint in endpoints if self.available(endpoint)
+        ] or endpoints
+
+    def started(self, endpoint):
+        self.breaker(endpoint.region).started()
+        self.breaker(endpoint.proxy_url).started()
+
+    def record(self, endpoint, failed, gateway_failed, elapsed=None):
+        # A broken target host only takes its own endpoints out of rotation, never whole regions
+        self.breaker(endpoint.region).record(gateway_failed, elapsed)
+        self.breaker(endpoint.proxy_url).record(failed, elapsed)
+
+    def forget(self, endpoints):
+        for endpoint in endpoints:
+            self.breakers.pop(endpoint.proxy_url, None)
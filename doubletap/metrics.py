@@ -0,0 +1,128 @@
+import time
+import bisect
+import asyncio
+import logging
+from contextlib import contextmanager
+
+log = logging.getLogger("doubletap.metrics")
+
+# Seconds, spans everything from a proxied request to an API Gateway deployment going live
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # Label values => [count per bucket plus +Inf, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+
+        entry = self.values[key]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", key + (le,), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, cumulative
+
+
+_metrics = {}
+
+
+def counter(name, help, labels=()):
+    if name not in _metrics:
+        _metrics[name] = Counter(name, help, labels)
+    return _metrics[name]
+
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    if name not in _metrics:
+        _metrics[name] = Histogram(name, help, labels, buckets)
+    return _metrics[name]
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+def render():
+    # Prometheus text exposition format
+    lines = []
+    for metric in _metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, key, value in metric.samples():
+            names = metric.labels + (("le",) if name.endswith("_bucket") else ())
+            lines.append(f"{name}{format_labels(names, key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def handle(reader, writer):
+    try:
+        # Whatever got asked for, there's only one thing to serve
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % len(body)
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle, host, port)
+    log.debug(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
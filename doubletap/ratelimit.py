@@ -0,0 +1,227 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import contextvars
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from doubletap import metrics
+
+log = logging.getLogger("doubletap.ratelimit")
+
+THROTTLING_ERRORS = {"TooManyRequestsException", "ThrottlingException"}
+
+# API Gateway control plane quotas, (requests per second, burst) per account and region.
+# Everything shares the account wide budget, the operations below are further limited on their own.
+ACCOUNT_BUDGET = (10, 40)
+OPERATION_BUDGETS = {
+    "create_deployment": (1 / 5, 1),
+    "create_resource": (5, 5),
+    "create_rest_api": (1 / 3, 1),
+    "delete_resource": (5, 5),
+    "delete_api": (1 / 30, 1),
+    "get_resources": (5 / 2, 5),
+    "import_api": (1, 1),
+}
+
+MAX_CONCURRENCY = 5
+# Slots per region only interactive calls can take, a cold host never queues behind bulk work
+RESERVED_CONCURRENCY = 1
+MAX_RETRIES = 6
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 20
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Takes a token and returns how long the caller has to wait before using it.
+        # Tokens are allowed to go negative so waiters are served in the order they arrived.
+        self.refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def available(self):
+        # How long until a whole token is in the bucket, without taking it
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def throttled(self):
+        self.rate = max(self.max_rate / 8, self.rate / 2)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+# Lower goes first, calls made outside of any prioritize() block are interactive
+INTERACTIVE = 0
+PRESTAGE = 1
+BACKGROUND = 2
+PRIORITY_NAMES = ("interactive", "prestage", "background")
+
+API_CALLS = metrics.histogram(
+    "doubletap_api_call_seconds",
+    "API Gateway control plane call latency",
+    ("region", "operation"),
+)
+API_QUEUED = metrics.histogram(
+    "doubletap_api_queue_seconds",
+    "Time API Gateway calls waited for a concurrency slot and rate limit tokens",
+    ("region", "priority"),
+)
+API_THROTTLED = metrics.counter(
+    "doubletap_api_throttled_total",
+    "API Gateway calls that got throttled",
+    ("region", "operation"),
+)
+
+# Inherited by every task spawned from within a prioritize() block
+priority = contextvars.ContextVar("priority", default=INTERACTIVE)
+
+
+@contextmanager
+def prioritize(level):
+    token = priority.set(level)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+class PriorityGate:
+    # Concurrency limit handing out slots by priority, then in the order they were asked for
+    def __init__(self, concurrency, reserved=RESERVED_CONCURRENCY):
+        self.concurrency = concurrency
+        self.reserved = min(reserved, concurrency - 1)
+        self.active = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    def limit(self, level):
+        return (
+            self.concurrency
+            if level == INTERACTIVE
+            else self.concurrency - self.reserved
+        )
+
+    async def acquire(self, level):
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (level, next(self._counter), waiter))
+        self.wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.cancelled():
+                # Got the slot right as it was cancelled
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def wake(self):
+        while self._waiters:
+            level, _, waiter = self._waiters[0]
+            if waiter.done():
+                heapq.heappop(self._waiters)
+                continue
+            # Lower priorities never get more slots than the head of the queue, nothing behind it can go either
+            if self.active >= self.limit(level):
+                return
+
+            heapq.heappop(self._waiters)
+            self.active += 1
+            waiter.set_result(None)
+
+
+class RateLimiter:
+    def __init__(self, region, concurrency=MAX_CONCURRENCY, retries=MAX_RETRIES):
+        self.region = region
+        self.concurrency = concurrency
+        self.retries = retries
+        self.account = TokenBucket(*ACCOUNT_BUDGET)
+        self.buckets = {
+            operation: TokenBucket(*budget)
+            for operation, budget in OPERATION_BUDGETS.items()
+        }
+        self.gate = PriorityGate(concurrency)
+
+    async def take(self, level, bucket):
+        buckets = [self.account] if bucket is self.account else [self.account, bucket]
+        if level == INTERACTIVE:
+            # Interactive calls borrow against future tokens and are served in the order they arrived
+            delay = max([limit.reserve() for limit in buckets])
+        else:
+            # Everything else only takes tokens that are already there, so it never runs the buckets
+            # into debt and interactive calls never wait on tokens bulk work has borrowed
+            while True:
+                delay = max([limit.available() for limit in buckets])
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+            for limit in buckets:
+                limit.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def call(self, operation, func, *args, **kwargs):
+        level = priority.get()
+        bucket = self.buckets.get(operation, self.account)
+        for attempt in range(self.retries + 1):
+            queued = time.monotonic()
+            # Tokens are taken before slots, nobody holds on to a slot while waiting for the rate limit
+            await self.take(level, bucket)
+            await self.gate.acquire(level)
+            try:
+                started = time.monotonic()
+                API_QUEUED.observe(
+                    started - queued, region=self.region, priority=PRIORITY_NAMES[level]
+                )
+                try:
+                    result = await func(*args, **kwargs)
+                except ClientError as e:
+                    if e.response["Error"]["Code"] not in THROTTLING_ERRORS:
+                        raise
+                    API_THROTTLED.inc(region=self.region, operation=operation)
+                    bucket.throttled()
+                    if attempt == self.retries:
+                        raise
+                else:
+                    bucket.succeeded()
+                    return result
+                finally:
+                    API_CALLS.observe(
+                        time.monotonic() - started, region=self.region, operation=operation
+                    )
+            finally:
+                self.gate.release()
+
+            backoff = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+            log.warning(
+                f"{operation} throttled in {self.region}, retrying in {backoff:.2f}s (attempt {attempt + 1}/{self.retries})"
+            )
+            await asyncio.sleep(backoff)
+
+
+_limiters = {}
+
+
+def get_rate_limiter(region):
+    if region not in _limiters:
+        _limiters[region] = RateLimiter(region)
+    return _limiters[region]
@@ -0,0 +1,84 @@
+import time
+import asyncio
+import logging
+import httpx
+
+log = logging.getLogger("doubletap.readiness")
+
+# Errors API Gateway answers with while a deployment hasn't propagated to the endpoint yet
+NOT_READY_ERRORS = [
+    "MissingAuthenticationTokenException",
+    "ForbiddenException",
+    "NotFoundException",
+]
+
+# Requested through the {proxy+} resource, which is created last so it being reachable means the whole endpoint is
+PROBE_PATH = "favicon.ico"
+
+
+class ReadinessChecker:
+    def __init__(
+        self, client, timeout=120, initial_delay=0.25, max_delay=5, factor=1.5
+    ):
+        self.client = client
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self._probes = {}
+
+    async def wait(self, proxy, deployment_id, proxy_url):
+        # Deployments snapshot the whole API, so every endpoint deployed together shares one probe
+        key = (proxy.apigw.id, deployment_id)
+        if key not in self._probes:
+            for stale in [k for k, p in self._probes.items() if p.done() and k[0] == key[0]]:
+                del self._probes[stale]
+
+            self._probes[key] = asyncio.ensure_future(
+                self.probe(proxy, deployment_id, proxy_url)
+            )
+
+        return await asyncio.shield(self._probes[key])
+
+    async def probe(self, proxy, deployment_id, proxy_url):
+        deadline = time.monotonic() + self.timeout
+        delay = self.initial_delay
+
+        async def backoff():
+            nonlocal delay
+            if time.monotonic() + delay > deadline:
+                return False
+            await asyncio.sleep(delay)
+            delay = min(self.max_delay, delay * self.factor)
+            return True
+
+        log.debug(f"Waiting for deployment {deployment_id} to go live in {proxy.region}")
+        # A newer deployment of ours on the stage includes this one as well
+        while await proxy.get_stage_deployment_id() not in (
+            deployment_id,
+            proxy.deployment_id,
+        ):
+            if not await backoff():
+                log.warning(
+                    f"Deployment {deployment_id} didn't show up on the {proxy.name} stage in {proxy.region} after {self.timeout}s"
+                )
+                return False
+
+        while True:
+            try:
+                r = await self.client.head(proxy_url + PROBE_PATH)
+                if r.status_code not in (403, 404) or r.headers.get(
+                    "x-amzn-ErrorType", ""
+                ).split(":")[0] not in NOT_READY_ERRORS:
+                    log.debug(
+                        f"Deployment {deployment_id} is live in {proxy.region} (status code: {r.status_code})"
+                    )
+                    return True
+            except httpx.HTTPError as e:
+                log.debug(f"Probing {proxy_url} failed: {e}")
+
+            if not await backoff():
+                log.warning(
+                    f"Deployment {deployment_id} in {proxy.region} still isn't live after {self.timeout}s, giving up on waiting"
+                )
+                return False
@@ -0,0 +1,174 @@
+import sqlite3
+import logging
+import pathlib
+
+log = logging.getLogger("doubletap.registry")
+
+
+class ProxyRegistry:
+    def __init__(self, path):
+        self.path = pathlib.Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(str(self.path), isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS apis (
+                name TEXT NOT NULL,
+                region TEXT NOT NULL,
+                api_id TEXT NOT NULL,
+                deployment_id TEXT,
+                PRIMARY KEY (name, region)
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS endpoints (
+                api_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                region TEXT NOT NULL,
+                resource_id TEXT NOT NULL,
+                path_part TEXT NOT NULL,
+                PRIMARY KEY (api_id, url)
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS standby (
+                api_id TEXT NOT NULL,
+                region TEXT NOT NULL,
+                resource_id TEXT NOT NULL,
+                path_part TEXT NOT NULL,
+                PRIMARY KEY (api_id, path_part)
+            )"""
+        )
+        # Endpoints pointed at their host through a stage variable, claimed standby endpoints
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS variables (
+                api_id TEXT NOT NULL,
+                path_part TEXT NOT NULL,
+                PRIMARY KEY (api_id, path_part)
+            )"""
+        )
+        log.debug(f"Using proxy registry at {self.path}")
+
+    def get_api(self, name, region):
+        return self.db.execute(
+            "SELECT api_id, deployment_id FROM apis WHERE name = ? AND region = ?",
+            (name, region),
+        ).fetchone()
+
+    def get_apis(self, region):
+        return self.db.execute(
+            "SELECT name, api_id, deployment_id FROM apis WHERE region = ?", (region,)
+        ).fetchall()
+
+    def get_endpoints(self, api_id):
+        return self.db.execute(
+            "SELECT url, resource_id, path_part FROM endpoints WHERE api_id = ?",
+            (api_id,),
+        ).fetchall()
+
+    def get_standby(self, api_id):
+        return self.db.execute(
+            "SELECT resource_id, path_part FROM standby WHERE api_id = ?", (api_id,)
+        ).fetchall()
+
+    def get_variables(self, api_id):
+        return {
+            path_part
+            for (path_part,) in self.db.execute(
+                "SELECT path_part FROM variables WHERE api_id = ?", (api_id,)
+            )
+        }
+
+    def set_api(self, name, region, api_id, deployment_id=None):
+        self.db.execute(
+            "INSERT OR REPLACE INTO apis VALUES (?, ?, ?, ?)",
+            (name, region, api_id, deployment_id),
+        )
+
+    def add_endpoint(self, api_id, url, region, resource_id, path_part):
+        self.db.execute(
+            "INSERT OR REPLACE INTO endpoints VALUES (?, ?, ?, ?, ?)",
+            (api_id, url, region, resource_id, path_part),
+        )
+
+    def remove_endpoint(self, api_id, path_part):
+        with self.db:
+            self.db.execute("BEGIN")
+            for table in ("endpoints", "standby", "variables"):
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE api_id = ? AND path_part = ?",
+                    (api_id, path_part),
+                )
+
+    def add_standby(self, api_id, region, resource_id, path_part):
+        self.db.execute(
+            "INSERT OR REPLACE INTO standby VALUES (?, ?, ?, ?)",
+            (api_id, region, resource_id, path_part),
+        )
+
+    def claim_standby(self, api_id, url, region, resource_id, path_part):
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                "DELETE FROM standby WHERE api_id = ? AND path_part = ?",
+                (api_id, path_part),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO endpoints VALUES (?, ?, ?, ?, ?)",
+                (api_id, url, region, resource_id, path_part),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO variables VALUES (?, ?)", (api_id, path_part)
+            )
+
+    def replace(
+        self, name, region, api_id, deployment_id, endpoints, standby=(), variables=()
+    ):
+        with self.db:
+            self.db.execute("BEGIN")
+            for table in ("endpoints", "standby", "variables"):
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE api_id IN "
+                    "(SELECT api_id FROM apis WHERE name = ? AND region = ?)",
+                    (name, region),
+                )
+                self.db.execute(f"DELETE FROM {table} WHERE api_id = ?", (api_id,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO apis VALUES (?, ?, ?, ?)",
+                (name, region, api_id, deployment_id),
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO endpoints VALUES (?, ?, ?, ?, ?)",
+                [
+                    (api_id, url, region, resource_id, path_part)
+                    for url, resource_id, path_part in endpoints
+                ],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO standby VALUES (?, ?, ?, ?)",
+                [
+                    (api_id, region, resource_id, path_part)
+                    for resource_id, path_part in standby
+                ],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO variables VALUES (?, ?)",
+                [(api_id, path_part) for path_part in variables],
+            )
+
+    def forget(self, name, region):
+        with self.db:
+            self.db.execute("BEGIN")
+            for table in ("endpoints", "standby", "variables"):
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE api_id IN "
+                    "(SELECT api_id FROM apis WHERE name = ? AND region = ?)",
+                    (name, region),
+                )
+            self.db.execute(
+                "DELETE FROM apis WHERE name = ? AND region = ?", (name, region)
+            )
+
+    def close(self):
+        self.db.close()
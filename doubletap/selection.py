@@ -0,0 +1,116 @@
+import random
+import itertools
+from collections import defaultdict
+
+
+class ProxySelector:
+    def select(self, flow, endpoints):
+        raise NotImplementedError
+
+    def started(self, endpoint):
+        pass
+
+    def finished(self, endpoint, elapsed=None):
+        pass
+
+    def disconnected(self, client_id):
+        pass
+
+
+class RandomSelector(ProxySelector):
+    def select(self, flow, endpoints):
+        return random.choice(endpoints)
+
+
+class RoundRobinSelector(ProxySelector):
+    def __init__(self):
+        self.counter = itertools.count()
+
+    def select(self, flow, endpoints):
+        return endpoints[next(self.counter) % len(endpoints)]
+
+
+class LeastOutstandingSelector(ProxySelector):
+    def __init__(self):
+        self.outstanding = defaultdict(int)
+
+    def select(self, flow, endpoints):
+        # Ties are broken at random so idle regions still get rotated through
+        return min(
+            endpoints,
+            key=lambda endpoint: (
+                self.outstanding[endpoint.region],
+                random.random(),
+            ),
+        )
+
+    def started(self, endpoint):
+        self.outstanding[endpoint.region] += 1
+
+    def finished(self, endpoint, elapsed=None):
+        region = endpoint.region
+        if self.outstanding[region] > 0:
+            self.outstanding[region] -= 1
+
+
+class LatencyWeightedSelector(ProxySelector):
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.latencies = {}
+
+    def select(self, flow, endpoints):
+        # Regions we haven't heard back from yet get the best latency seen so far so they're tried early
+        best = min(self.latencies.values(), default=1.0)
+        weights = [
+            1 / max(self.latencies.get(endpoint.region, best), 0.001)
+            for endpoint in endpoints
+        ]
+        return random.choices(endpoints, weights)[0]
+
+    def finished(self, endpoint, elapsed=None):
+        if elapsed is None:
+            return
+
+        region = endpoint.region
+        if region not in self.latencies:
+            self.latencies[region] = elapsed
+        else:
+            self.latencies[region] += self.alpha * (elapsed - self.latencies[region])
+
+
+class RegionStickySelector(ProxySelector):
+    # Every region is a single execute-api host, so keeping a client on one region lets
+    # mitmproxy reuse the upstream connection instead of doing a new TLS handshake per request
+    def __init__(self, requests=0):
+        self.requests = requests
+        self.regions = {}
+
+    def select(self, flow, endpoints):
+        client_id = flow.client_conn.id
+        sticky = self.regions.get(client_id)
+        if sticky:
+            region, count = sticky
+            if not self.requests or count < self.requests:
+                for endpoint in endpoints:
+                    if endpoint.region == region:
+                        sticky[1] += 1
+                        return endpoint
+
+            # Rotating, move on to another region if there is one
+            endpoints = [e for e in endpoints if e.region != region] or endpoints
+
+        endpoint = random.choice(endpoints)
+        self.regions[client_id] = [endpoint.region, 1]
+        return endpoint
+
+    def disconnected(self, client_id):
+        self.regions.pop(client_id, None)
+
+
+SELECTORS = {
+    "random": RandomSelector,
+    "round-robin": RoundRobinSelector,
+    "least-outstanding": LeastOutstandingSelector,
+    "latency": LatencyWeightedSelector,
+    "sticky": RegionStickySelector,
+}
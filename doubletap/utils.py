@@ -5,15 +5,55 @@ import logging
 import os
 import sys
 import pathlib
+import bisect
+import ipaddress
 from configparser import ConfigParser
 from functools import lru_cache
-from faker import Faker
-from faker.providers import internet
 
 log = logging.getLogger("doubletap.utils")
 
-fake = Faker()
-fake.add_provider(internet)
+# Special purpose IPv4 blocks (RFC 6890 and friends) that never show up as a real client address
+RESERVED_IPV4_NETWORKS = [
+    "0.0.0.0/8",
+    "10.0.0.0/8",
+    "100.64.0.0/10",
+    "127.0.0.0/8",
+    "169.254.0.0/16",
+    "172.16.0.0/12",
+    "192.0.0.0/24",
+    "192.0.2.0/24",
+    "192.88.99.0/24",
+    "192.168.0.0/16",
+    "198.18.0.0/15",
+    "198.51.100.0/24",
+    "203.0.113.0/24",
+    "224.0.0.0/4",
+    "240.0.0.0/4",
+]
+
+
+def get_public_ipv4_ranges():
+    # Returns the start of every public range and how many addresses come before it,
+    # so a random offset into the public address space maps back to an address with a bisect
+    starts, offsets, total = [], [], 0
+    start = 0
+    for network in sorted(ipaddress.ip_network(n) for n in RESERVED_IPV4_NETWORKS):
+        first = int(network.network_address)
+        if first > start:
+            starts.append(start)
+            offsets.append(total)
+            total += first - start
+        start = max(start, int(network.broadcast_address) + 1)
+
+    if start < 2 ** 32:
+        starts.append(start)
+        offsets.append(total)
+        total += 2 ** 32 - start
+
+    return starts, offsets, total
+
+
+PUBLIC_IPV4_STARTS, PUBLIC_IPV4_OFFSETS, PUBLIC_IPV4_TOTAL = get_public_ipv4_ranges()
 
 
 @lru_cache
@@ -74,8 +114,11 @@ def gen_urls_from_entries(inputs):
             for scheme in ["https", "http"]:
                 yield f"{scheme}://{host}/"
 
-def gen_random_ip():
-    return fake.ipv4_public()
+def gen_random_ip(rng=random):
+    n = rng.randrange(PUBLIC_IPV4_TOTAL)
+    i = bisect.bisect_right(PUBLIC_IPV4_OFFSETS, n) - 1
+    ip = PUBLIC_IPV4_STARTS[i] + n - PUBLIC_IPV4_OFFSETS[i]
+    return f"{ip >> 24}.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}"
 
 
 def beautify_json(obj):
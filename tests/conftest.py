@@ -0,0 +1,63 @@
+import pathlib
+import importlib.util
+import pytest
+from doubletap import ratelimit
+from doubletap.aws import AWSProxies, ProxyEndpoint
+from doubletap.utils import get_aws_credentials
+from benchmarks.bench import scaled_budgets
+from benchmarks.fakeapigw import ControlPlane, DataPlane, FakeSession
+
+ROOT = pathlib.Path(__file__).parent.parent
+QUOTA_SCALE = 100
+
+
+@pytest.fixture
+def endpoint():
+    def make(region, path_part="p"):
+        host = f"abc.execute-api.{region}.amazonaws.com"
+        path = f"/DOUBLETAP-0/{path_part}/"
+        return ProxyEndpoint(region, "abc", "r", path_part, host, path, f"https://{host}{path}")
+
+    return make
+
+
+@pytest.fixture
+def aws_credentials(monkeypatch):
+    # The credentials lookup is cached, nothing may leak into or out of a test
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    get_aws_credentials.cache_clear()
+    yield
+    get_aws_credentials.cache_clear()
+
+
+@pytest.fixture
+def fake_aws(monkeypatch, aws_credentials):
+    # AWSProxies against the benchmark's fake API Gateway, every test starts with fresh rate limits.
+    # Deployments alone would take 5s each with the real quotas.
+    monkeypatch.setattr(ratelimit, "_limiters", {})
+    plane = ControlPlane(latency=0, staging_delay=0, quota_scale=QUOTA_SCALE)
+
+    def make(regions=("us-east-1",), **kwargs):
+        proxies = AWSProxies(regions=list(regions), **kwargs)
+        proxies.session = FakeSession(plane)
+        proxies.readiness.client = DataPlane(plane)
+        return proxies
+
+    make.plane = plane
+    with scaled_budgets(QUOTA_SCALE):
+        yield make
+
+
+@pytest.fixture(scope="session")
+def addon_module():
+    # The mitmproxy script sits next to the doubletap package and shares its name
+    spec = importlib.util.spec_from_file_location("doubletap_addon", ROOT / "doubletap.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def addon(addon_module, aws_credentials):
+    return addon_module.DoubleTap()
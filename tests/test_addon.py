@@ -0,0 +1,59 @@
+import time
+from mitmproxy.test import taddons, tflow
+
+
+def flow_with_headers(*fields):
+    flow = tflow.tflow(resp=True)
+    flow.response.headers.fields = tuple((k.encode(), v.encode()) for k, v in fields)
+    return flow
+
+
+def test_remapped_headers_replace_the_gateways(addon):
+    flow = flow_with_headers(
+        ("Date", "gateway"),
+        ("x-amzn-Remapped-Date", "backend"),
+        ("Server", "backend"),
+    )
+    addon.remap_headers(flow)
+    assert flow.response.headers.fields == ((b"Date", b"backend"), (b"Server", b"backend"))
+
+
+def test_repeated_headers_are_kept(addon):
+    flow = flow_with_headers(
+        ("Set-Cookie", "a=1"),
+        ("x-amzn-Remapped-Set-Cookie", "b=2"),
+        ("x-amzn-Remapped-Set-Cookie", "c=3"),
+    )
+    addon.remap_headers(flow)
+    assert flow.response.headers.get_all("Set-Cookie") == ["b=2", "c=3"]
+
+
+def test_framing_headers_are_left_alone(addon):
+    fields = (
+        ("Content-Length", "10"),
+        ("Connection", "keep-alive"),
+        ("x-amzn-Remapped-Content-Length", "20"),
+        ("x-amzn-Remapped-Connection", "close"),
+        ("x-amzn-Remapped-Transfer-Encoding", "chunked"),
+    )
+    flow = flow_with_headers(*fields)
+    addon.remap_headers(flow)
+    assert flow.response.headers.fields == tuple((k.encode(), v.encode()) for k, v in fields)
+
+
+def test_streaming_is_decided_on_the_gateways_headers(addon):
+    flow = flow_with_headers(("Content-Length", "1000"), ("x-amzn-Remapped-Content-Length", "10"))
+    with taddons.context(addon) as tctx:
+        tctx.configure(addon, stream_threshold="100")
+        addon.responseheaders(flow)
+    assert flow.response.stream
+
+
+def test_attempts_only_get_counted_once(addon, endpoint):
+    sent = endpoint("us-east-1")
+    flow = tflow.tflow(resp=True, err=True)
+    flow.metadata["doubletap"] = {"endpoint": sent, "endpoints": [sent], "started": time.monotonic()}
+
+    addon.request_finished(flow)
+    addon.request_finished(flow)
+    assert addon.health.breaker(sent.proxy_url).requests == 1
@@ -0,0 +1,58 @@
+import re
+import pytest
+from doubletap.allowlist import AllowList
+
+
+def test_matches_any_pattern():
+    allowlist = AllowList([r"example\.com", r"^http://foo\.org/"])
+    assert allowlist.allowed("https", "www.example.com")
+    assert allowlist.allowed("http", "foo.org")
+    assert not allowlist.allowed("https", "foo.org")
+    assert not allowlist.allowed("https", "bar.net")
+    assert len(allowlist.regexes) == 1
+
+
+def test_named_groups_get_matched_on_their_own():
+    allowlist = AllowList([r"(?P<h>example)\.com", r"(?P<h>foo)\.org"])
+    assert allowlist.allowed("https", "example.com")
+    assert allowlist.allowed("https", "foo.org")
+
+
+def test_conditional_group_references_get_matched_on_their_own():
+    allowlist = AllowList([r"(www\.)?foo\.org", r"(a)?(?(1)x|y)\.com"])
+    assert allowlist.allowed("https", "ax.com")
+    assert allowlist.allowed("https", "y.com")
+    assert not allowlist.allowed("https", "x.com")
+
+
+def test_backreferences_and_flags_get_matched_on_their_own():
+    allowlist = AllowList([r"(a)\1\.com", r"(?i)EXAMPLE\.com", r"foo\.org"])
+    assert allowlist.allowed("https", "aa.com")
+    assert allowlist.allowed("https", "example.com")
+    assert allowlist.allowed("https", "foo.org")
+    assert not allowlist.allowed("https", "FOO.org")
+
+
+def test_broken_pattern_is_rejected():
+    allowlist = AllowList()
+    with pytest.raises(re.error):
+        allowlist.add("(unclosed")
+    assert len(allowlist) == 0
+
+
+def test_cache_is_cleared_on_compile():
+    allowlist = AllowList([r"example\.com"])
+    assert not allowlist.allowed("https", "foo.org")
+    assert allowlist.allowed.cache_info().currsize == 1
+
+    allowlist.add(r"foo\.org")
+    allowlist.compile()
+    assert allowlist.allowed.cache_info().currsize == 0
+    assert allowlist.allowed("https", "foo.org")
+
+
+def test_falls_back_to_single_regexes_when_merging_fails(monkeypatch):
+    monkeypatch.setattr("doubletap.allowlist.UNMERGEABLE", re.compile(r"(?!)"))
+    allowlist = AllowList([r"(?P<h>example)\.com", r"(?P<h>foo)\.org"])
+    assert len(allowlist.regexes) == 2
+    assert allowlist.allowed("https", "foo.org")
@@ -0,0 +1,176 @@
+import time
+import asyncio
+from doubletap.aws import AWSApiGatewayProxy, DeploymentScheduler
+from doubletap.ratelimit import priority, prioritize, INTERACTIVE, BACKGROUND
+from doubletap.registry import ProxyRegistry
+
+REGIONS = ("us-east-1", "eu-west-1")
+
+
+def test_prestaged_hosts_get_released_at_their_quorum(fake_aws):
+    async def run():
+        proxies = fake_aws(REGIONS)
+        proxies.quorum = 1
+        await proxies.setup()
+
+        # One region never goes live until the test lets it
+        released = asyncio.Event()
+        wait = proxies.readiness.wait
+
+        async def slow(proxy, *args):
+            if proxy.region == "eu-west-1":
+                await released.wait()
+            return await wait(proxy, *args)
+
+        proxies.readiness.wait = slow
+        urls = [f"https://host-{i}.example.com/" for i in range(5)]
+        prestage = asyncio.ensure_future(proxies.bulk_create(urls))
+        await asyncio.sleep(0)
+
+        try:
+            endpoints = await asyncio.wait_for(proxies.create(urls[0]), 5)
+            assert [e.region for e in endpoints] == ["us-east-1"]
+            assert not prestage.done()
+
+            released.set()
+            await asyncio.wait_for(prestage, 5)
+            assert {e.region for e in proxies.get(urls[0])} == set(REGIONS)
+        finally:
+            await proxies.close()
+
+    asyncio.run(run())
+
+
+def test_registry_only_lists_deployed_endpoints(fake_aws, tmp_path):
+    async def run():
+        proxies = fake_aws()
+        registry = ProxyRegistry(tmp_path / "registry.db")
+        proxies.use_registry(registry)
+        await proxies.setup()
+        proxy = proxies.shards["us-east-1"][0]
+        url = "https://example.com/"
+
+        try:
+            endpoint = await proxy.create(url, "abc")
+            assert registry.get_endpoints(proxy.apigw.id) == []
+
+            deployment_id = await proxy.stage()
+            assert registry.get_endpoints(proxy.apigw.id) == [(url, endpoint.resource_id, "abc")]
+            assert registry.get_api(proxy.name, proxy.region) == (proxy.apigw.id, deployment_id)
+
+            # The stage tells whether the registry is stale, the deployment history never gets paged through
+            loaded = AWSApiGatewayProxy(proxy.name, region=proxy.region)
+            loaded.registry = registry
+            assert loaded.load()
+            loaded.apigw.session = proxy.apigw.session
+            calls = fake_aws.plane.calls["get_deployments"]
+            assert set(await loaded.verify()) == {url}
+            assert fake_aws.plane.calls["get_deployments"] == calls
+            await loaded.apigw.close()
+        finally:
+            await proxies.close()
+            registry.close()
+
+    asyncio.run(run())
+
+
+def test_deployments_requested_together_get_coalesced():
+    async def run():
+        deployments = []
+
+        async def deploy():
+            deployments.append(priority.get())
+            await asyncio.sleep(0.05)
+            return len(deployments)
+
+        scheduler = DeploymentScheduler(deploy, window=0.01)
+        with prioritize(BACKGROUND):
+            first = asyncio.ensure_future(scheduler.request())
+        together = await asyncio.gather(first, scheduler.request(), scheduler.request())
+
+        # Requested while the first one is underway, it might not include what this is asking for
+        running = asyncio.ensure_future(scheduler.request())
+        await asyncio.sleep(0.02)
+        later = scheduler.request()
+        return together, await asyncio.gather(running, later), deployments
+
+    together, later, deployments = asyncio.run(run())
+    assert together == [1, 1, 1]
+    assert later == [2, 3]
+    # A live request riding along with a background one bumps the deployment's priority
+    assert deployments[0] == INTERACTIVE
+
+
+def test_reserve_fills_shards_in_order(fake_aws):
+    proxies = fake_aws(shard_capacity=3)
+    first = proxies.shards["us-east-1"][0]
+
+    assignments = proxies.reserve("us-east-1", ["a", "b", "c", "d", "e"])
+    assert [(proxy.name, chunk) for proxy, chunk in assignments] == [
+        ("DOUBLETAP-0", ["a", "b", "c"]),
+        ("DOUBLETAP-1", ["d", "e"]),
+    ]
+    assert proxies.free(first) == 0
+
+    proxies.release(first, ["a", "b", "c"])
+    first.add_endpoint("https://a.example.com/", "r", "p")
+    first.standby.append(("r2", "p2"))
+    assert proxies.free(first) == 1
+    assert proxies.reserve("us-east-1", ["f"])[0][0] is first
+
+
+def test_quorum_releases_flows_before_every_region_is_live(fake_aws):
+    async def run():
+        proxies = fake_aws(REGIONS)
+        proxies.quorum = 1
+        await proxies.setup()
+
+        released = asyncio.Event()
+        wait = proxies.readiness.wait
+
+        async def slow(proxy, *args):
+            if proxy.region == "eu-west-1":
+                await released.wait()
+            return await wait(proxy, *args)
+
+        proxies.readiness.wait = slow
+        url = "https://example.com/"
+        try:
+            endpoints = await asyncio.wait_for(proxies.create(url), 5)
+            assert [e.region for e in endpoints] == ["us-east-1"]
+            assert url in proxies._pending
+
+            released.set()
+            while url in proxies._pending:
+                await asyncio.sleep(0.01)
+            assert {e.region for e in proxies.get(url)} == set(REGIONS)
+        finally:
+            await proxies.close()
+
+    asyncio.run(run())
+
+
+def test_evicts_expired_then_least_recently_used_hosts(fake_aws):
+    async def run():
+        proxies = fake_aws()
+        await proxies.setup()
+        urls = [f"https://host-{i}.example.com/" for i in range(4)]
+        try:
+            await proxies.bulk_create(urls)
+            proxy = proxies.shards["us-east-1"][0]
+            endpoints = [proxy.endpoints[url] for url in urls]
+            now = time.monotonic()
+            # host-0 expired, host-3 was used just now, the others have been idle from oldest to newest
+            for url, idle in zip(urls, (400, 200, 100, 0)):
+                proxies.last_used[url] = now - idle
+
+            assert await proxies.evict(ttl=300) == endpoints[:1]
+            assert await proxies.evict(ttl=300, capacity=2) == endpoints[1:2]
+            # Hosts used within the last collection interval are never evicted
+            assert await proxies.evict(capacity=1) == endpoints[2:3]
+            assert set(proxies.index) == set(urls[3:])
+            assert set(proxy.endpoints) == set(urls[3:])
+        finally:
+            await proxies.close()
+
+    asyncio.run(run())
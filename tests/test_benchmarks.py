@@ -0,0 +1,33 @@
+import asyncio
+import argparse
+from doubletap import ratelimit
+from benchmarks.bench import run
+
+
+def test_benchmark_runs_offline(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "benchmark")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "benchmark")
+    args = argparse.Namespace(
+        regions=2,
+        latency=0,
+        staging_delay=0,
+        quota_scale=100,
+        prestage=20,
+        standby=2,
+        cold=3,
+        quorum=1,
+        proxy_method="random",
+        requests=200,
+        seed=0,
+    )
+
+    budgets = ratelimit.ACCOUNT_BUDGET, ratelimit.OPERATION_BUDGETS
+    results = asyncio.run(run(args))
+
+    assert results["prestage"]["staged"] == 20
+    assert results["cold"]["dropped"] == 0
+    assert results["requests"]["errors"] == 0
+    assert results["control_plane"]["throttled"] == 0
+    # Nothing of the scaled budgets is left behind for whatever runs next
+    assert (ratelimit.ACCOUNT_BUDGET, ratelimit.OPERATION_BUDGETS) == budgets
+    assert not ratelimit._limiters
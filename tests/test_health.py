@@ -0,0 +1,65 @@
+from doubletap.health import HealthTracker, is_failure, is_gateway_failure
+
+
+def test_failures():
+    assert is_failure(503, {})
+    assert is_failure(429, {})
+    assert not is_failure(404, {})
+    assert is_gateway_failure(429, {})
+    assert is_gateway_failure(403, {"x-amzn-ErrorType": "ForbiddenException"})
+    assert not is_gateway_failure(503, {})
+
+
+def test_origin_errors_only_trip_their_endpoint(endpoint):
+    health = HealthTracker()
+    broken, other = endpoint("us-east-1", "a"), endpoint("us-east-1", "b")
+    for _ in range(20):
+        health.record(broken, True, False)
+
+    assert not health.available(broken)
+    assert health.available(other)
+    assert health.filter([broken, other]) == [other]
+
+
+def test_gateway_errors_trip_the_region(endpoint):
+    health = HealthTracker()
+    first, second = endpoint("us-east-1", "a"), endpoint("us-east-1", "b")
+    elsewhere = endpoint("eu-west-1", "a")
+    for _ in range(20):
+        health.record(first, True, True)
+
+    assert not health.available(second)
+    assert health.filter([first, second, elsewhere]) == [elsewhere]
+    # Nothing healthy left, everything stays in rotation
+    assert health.filter([first, second]) == [first, second]
+
+
+def test_forget(endpoint):
+    health = HealthTracker()
+    gone = endpoint("us-east-1", "a")
+    health.record(gone, True, False)
+    health.forget([gone])
+    assert gone.proxy_url not in health.breakers
+    assert "us-east-1" in health.breakers
+
+
+def test_half_open_breakers_only_let_a_few_probes_through(endpoint):
+    health = HealthTracker(cooldown=0)
+    broken = endpoint("us-east-1", "a")
+    for _ in range(20):
+        health.record(broken, True, False)
+
+    breaker = health.breaker(broken.proxy_url)
+    for _ in range(breaker.probes):
+        assert health.available(broken)
+        health.started(broken)
+    assert not health.available(broken)
+
+    # A failed probe reopens it, enough good ones close it again
+    health.record(broken, True, False)
+    assert breaker.state == "open"
+    for _ in range(breaker.probes):
+        assert health.available(broken)
+        health.started(broken)
+        health.record(broken, False, False)
+    assert breaker.state == "closed"
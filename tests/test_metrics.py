@@ -0,0 +1,39 @@
+import pytest
+from doubletap import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", {})
+
+
+def test_render():
+    requests = metrics.counter("requests_total", "Requests", ("region", "code"))
+    requests.inc(region="us-east-1", code=200)
+    requests.inc(2, region="us-east-1", code=200)
+    requests.inc(region='eu-"west"', code="error")
+    latency = metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert metrics.render() == "\n".join(
+        [
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{region="us-east-1",code="200"} 3',
+            'requests_total{region="eu-\\"west\\"",code="error"} 1',
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            "latency_seconds_sum 5.55",
+            "latency_seconds_count 3",
+            "",
+        ]
+    )
+
+
+def test_metrics_are_registered_once():
+    assert metrics.counter("requests_total", "Requests") is metrics.counter("requests_total", "Requests")
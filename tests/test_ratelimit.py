@@ -0,0 +1,113 @@
+import asyncio
+import pytest
+from botocore.exceptions import ClientError
+from doubletap import ratelimit
+from doubletap.ratelimit import (
+    RateLimiter,
+    PriorityGate,
+    INTERACTIVE,
+    PRESTAGE,
+    BACKGROUND,
+)
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": ""}}, "Operation")
+
+
+class Flaky:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ratelimit, "BASE_BACKOFF", 0)
+
+
+def test_throttled_calls_get_retried():
+    limiter = RateLimiter("test-region")
+    func = Flaky([client_error("TooManyRequestsException")] * 2)
+    throttled = sum(ratelimit.API_THROTTLED.values.values())
+
+    assert asyncio.run(limiter.call("create_resource", func)) == "ok"
+    assert func.calls == 3
+    assert sum(ratelimit.API_THROTTLED.values.values()) == throttled + 2
+    bucket = limiter.buckets["create_resource"]
+    assert bucket.rate < bucket.max_rate
+
+
+def test_gives_up_after_the_last_retry():
+    limiter = RateLimiter("test-region", retries=1)
+    func = Flaky([client_error("TooManyRequestsException")] * 2)
+
+    with pytest.raises(ClientError):
+        asyncio.run(limiter.call("get_stage", func))
+    assert func.calls == 2
+
+
+def test_other_errors_are_not_retried():
+    limiter = RateLimiter("test-region")
+    func = Flaky([client_error("NotFoundException")])
+
+    with pytest.raises(ClientError):
+        asyncio.run(limiter.call("get_stage", func))
+    assert func.calls == 1
+
+
+def test_gate_hands_out_slots_by_priority():
+    async def run():
+        gate = PriorityGate(2, reserved=1)
+        order = []
+
+        async def take(level, name):
+            await gate.acquire(level)
+            order.append(name)
+            gate.release()
+
+        await gate.acquire(INTERACTIVE)
+        await gate.acquire(INTERACTIVE)
+        waiters = [
+            asyncio.ensure_future(take(BACKGROUND, "background")),
+            asyncio.ensure_future(take(PRESTAGE, "prestage")),
+            asyncio.ensure_future(take(INTERACTIVE, "interactive")),
+        ]
+        await asyncio.sleep(0)
+        gate.release()
+        gate.release()
+        await asyncio.wait_for(asyncio.gather(*waiters), 1)
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "prestage", "background"]
+
+
+def test_cold_host_during_a_prestage():
+    async def run():
+        limiter = RateLimiter("test-region")
+        limiter.buckets["create_resource"] = ratelimit.TokenBucket(10, 1)
+        finished = []
+
+        async def create(name):
+            finished.append(name)
+
+        async def prestage(name):
+            with ratelimit.prioritize(PRESTAGE):
+                await limiter.call("create_resource", create, name)
+
+        bulk = [asyncio.ensure_future(prestage(f"prestage-{i}")) for i in range(20)]
+        await asyncio.sleep(0)
+        try:
+            await asyncio.wait_for(limiter.call("create_resource", create, "interactive"), 0.5)
+        finally:
+            for task in bulk:
+                task.cancel()
+        return finished
+
+    assert asyncio.run(run()).index("interactive") <= 1
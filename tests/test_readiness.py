@@ -0,0 +1,72 @@
+import asyncio
+import httpx
+from doubletap.readiness import ReadinessChecker
+
+
+class Proxy:
+    def __init__(self, stages):
+        self.name = "DOUBLETAP-0"
+        self.region = "us-east-1"
+        self.deployment_id = "d2"
+        self.apigw = type("Api", (), {"id": "api"})()
+        self.stages = list(stages)
+
+    async def get_stage_deployment_id(self):
+        return self.stages.pop(0) if len(self.stages) > 1 else self.stages[0]
+
+
+class Client:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.probes = 0
+
+    async def head(self, url):
+        self.probes += 1
+        response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def not_ready():
+    return httpx.Response(403, headers={"x-amzn-ErrorType": "ForbiddenException"})
+
+
+def checker(client, timeout=1):
+    return ReadinessChecker(client, timeout=timeout, initial_delay=0.01, max_delay=0.01)
+
+
+def test_waits_for_the_stage_and_the_endpoint():
+    client = Client([not_ready(), httpx.ConnectError("refused", request=httpx.Request("HEAD", "https://api/")), httpx.Response(200)])
+    proxy = Proxy(["d0", "d1"])
+    assert asyncio.run(checker(client).wait(proxy, "d1", "https://api/"))
+    assert client.probes == 3
+    assert proxy.stages == ["d1"]
+
+
+def test_backend_errors_mean_the_endpoint_is_live():
+    client = Client([httpx.Response(404)])
+    assert asyncio.run(checker(client).wait(Proxy(["d1"]), "d1", "https://api/"))
+
+
+def test_endpoints_deployed_together_share_a_probe():
+    async def run():
+        readiness = checker(client)
+        proxy = Proxy(["d1"])
+        return await asyncio.gather(
+            readiness.wait(proxy, "d1", "https://api/a/"),
+            readiness.wait(proxy, "d1", "https://api/b/"),
+        )
+
+    client = Client([not_ready(), httpx.Response(200)])
+    assert asyncio.run(run()) == [True, True]
+    assert client.probes == 2
+
+
+def test_gives_up_after_the_timeout():
+    client = Client([not_ready()])
+    assert not asyncio.run(checker(client, timeout=0.05).wait(Proxy(["d1"]), "d1", "https://api/"))
+    # Never showed up on the stage, nothing got probed
+    client = Client([httpx.Response(200)])
+    assert not asyncio.run(checker(client, timeout=0.05).wait(Proxy(["d0"]), "d1", "https://api/"))
+    assert client.probes == 0
@@ -0,0 +1,54 @@
+import pytest
+from doubletap.registry import ProxyRegistry
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = ProxyRegistry(tmp_path / "registry.db")
+    registry.set_api("DOUBLETAP-0", "us-east-1", "api", "deployment")
+    yield registry
+    registry.close()
+
+
+def test_endpoints(registry):
+    registry.add_endpoint("api", "https://example.com/", "us-east-1", "r1", "p1")
+    assert registry.get_api("DOUBLETAP-0", "us-east-1") == ("api", "deployment")
+    assert registry.get_endpoints("api") == [("https://example.com/", "r1", "p1")]
+
+    registry.remove_endpoint("api", "p1")
+    assert registry.get_endpoints("api") == []
+
+
+def test_claimed_standby_endpoints_use_stage_variables(registry):
+    registry.add_standby("api", "us-east-1", "r1", "p1")
+    registry.add_standby("api", "us-east-1", "r2", "p2")
+    registry.claim_standby("api", "https://example.com/", "us-east-1", "r1", "p1")
+
+    assert registry.get_standby("api") == [("r2", "p2")]
+    assert registry.get_endpoints("api") == [("https://example.com/", "r1", "p1")]
+    assert registry.get_variables("api") == {"p1"}
+
+    registry.remove_endpoint("api", "p1")
+    assert registry.get_variables("api") == set()
+
+
+def test_replace_and_forget(registry):
+    registry.add_endpoint("api", "https://stale.com/", "us-east-1", "r0", "p0")
+    registry.replace(
+        "DOUBLETAP-0",
+        "us-east-1",
+        "new",
+        "deployment",
+        [("https://example.com/", "r1", "p1")],
+        [("r2", "p2")],
+        {"p1"},
+    )
+    assert registry.get_endpoints("api") == []
+    assert registry.get_api("DOUBLETAP-0", "us-east-1") == ("new", "deployment")
+    assert registry.get_variables("new") == {"p1"}
+
+    registry.forget("DOUBLETAP-0", "us-east-1")
+    assert registry.get_api("DOUBLETAP-0", "us-east-1") is None
+    assert registry.get_endpoints("new") == []
+    assert registry.get_standby("new") == []
+    assert registry.get_variables("new") == set()
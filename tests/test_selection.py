@@ -0,0 +1,55 @@
+import pytest
+from collections import Counter
+from mitmproxy.test import tflow
+from doubletap.selection import (
+    RoundRobinSelector,
+    LeastOutstandingSelector,
+    LatencyWeightedSelector,
+    RegionStickySelector,
+)
+
+REGIONS = ["us-east-1", "us-west-2", "eu-west-1"]
+
+
+@pytest.fixture
+def endpoints(endpoint):
+    return [endpoint(region) for region in REGIONS]
+
+
+def test_round_robin(endpoints):
+    selector = RoundRobinSelector()
+    picked = [selector.select(None, endpoints).region for _ in range(6)]
+    assert picked == REGIONS * 2
+
+
+def test_least_outstanding(endpoints):
+    selector = LeastOutstandingSelector()
+    selector.started(endpoints[0])
+    selector.started(endpoints[1])
+    assert selector.select(None, endpoints) == endpoints[2]
+
+    selector.finished(endpoints[0])
+    selector.started(endpoints[2])
+    assert selector.select(None, endpoints) == endpoints[0]
+
+
+def test_latency_weighted_prefers_fast_regions(endpoints):
+    selector = LatencyWeightedSelector()
+    selector.finished(endpoints[0], 0.05)
+    selector.finished(endpoints[1], 2)
+    selector.finished(endpoints[2], 2)
+
+    picked = Counter(selector.select(None, endpoints).region for _ in range(1000))
+    assert picked["us-east-1"] > 800
+
+
+def test_sticky_rotates_after_n_requests(endpoints):
+    selector = RegionStickySelector(requests=3)
+    flow = tflow.tflow()
+    picked = [selector.select(flow, endpoints).region for _ in range(4)]
+
+    assert len(set(picked[:3])) == 1
+    assert picked[3] != picked[0]
+
+    selector.disconnected(flow.client_conn.id)
+    assert flow.client_conn.id not in selector.regions
@@ -1,2 +1,47 @@
+import random
+import ipaddress
 import pytest
+from doubletap.utils import (
+    RESERVED_IPV4_NETWORKS,
+    PUBLIC_IPV4_STARTS,
+    PUBLIC_IPV4_OFFSETS,
+    PUBLIC_IPV4_TOTAL,
+    gen_random_ip,
+)
 
+RESERVED = [ipaddress.ip_network(n) for n in RESERVED_IPV4_NETWORKS]
+
+
+def is_reserved(ip):
+    return any(ipaddress.ip_address(ip) in network for network in RESERVED)
+
+
+def test_public_ipv4_ranges_cover_everything_but_reserved():
+    reserved = sum(network.num_addresses for network in RESERVED)
+    assert PUBLIC_IPV4_TOTAL == 2 ** 32 - reserved
+
+
+@pytest.mark.parametrize("index", range(len(PUBLIC_IPV4_STARTS)))
+def test_public_ipv4_range_edges(index):
+    rng = random.Random()
+    first = PUBLIC_IPV4_OFFSETS[index]
+    last = (
+        PUBLIC_IPV4_OFFSETS[index + 1]
+        if index + 1 < len(PUBLIC_IPV4_OFFSETS)
+        else PUBLIC_IPV4_TOTAL
+    ) - 1
+
+    for n in (first, last):
+        rng.randrange = lambda stop: n
+        assert not is_reserved(gen_random_ip(rng))
+
+
+def test_gen_random_ip_is_public():
+    assert not any(is_reserved(gen_random_ip()) for _ in range(10000))
+
+
+def test_gen_random_ip_seed():
+    first, second = random.Random(42), random.Random(42)
+    assert [gen_random_ip(first) for _ in range(5)] == [
+        gen_random_ip(second) for _ in range(5)
+    ]